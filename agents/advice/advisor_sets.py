@@ -138,4 +138,12 @@ new_advisors = [
     }),
     RandomMoveAdvisor(),
     FallbackSearchAdvisor(),
-]
\ No newline at end of file
+]
+
+def label_advisors(advisors, prefix=""):
+    # Labels look like "12:SequentialCompositeAdvisor/3:EngraveElberethAdvisor", by position in the advisor tree.
+    # Called by CustomAgent when advisor costs are being recorded, so importing this module leaves advisors untouched
+    for i, advisor in enumerate(advisors):
+        advisor.label = f"{prefix}{i}:{advisor.__class__.__name__}"
+        if isinstance(advisor, CompositeAdvisor):
+            label_advisors(advisor.advisors, advisor.label + "/")
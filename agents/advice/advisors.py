@@ -4,6 +4,7 @@ import enum
 from typing import NamedTuple
 import functools
 import re
+import time
 
 import agents.representation.glyphs as gd
 import nle.nethack as nethack
@@ -244,12 +245,34 @@ class Advisor(abc.ABC):
 
         return True
 
+    # Set by advisor_sets.label_advisors, when advisor costs are recorded, to tell apart instances of the same class
+    label = None
+
     def advice_on_conditions(self, rng, run_state, character, oracle):
+        if run_state.advisor_costs is not None:
+            return self.costed_advice_on_conditions(rng, run_state, character, oracle)
+
         if self.check_conditions(run_state, character, oracle):
             return self.advice(rng, run_state, character, oracle)
         else:
             return None
 
+    def costed_advice_on_conditions(self, rng, run_state, character, oracle):
+        # Seconds are inclusive, so a composite advisor's cost covers its children
+        start = time.perf_counter()
+        rejected = not self.check_conditions(run_state, character, oracle)
+        advice = None if rejected else self.advice(rng, run_state, character, oracle)
+
+        costs = run_state.advisor_costs.get(self.label or self.__class__.__name__, None)
+        if costs is None:
+            costs = {'seconds': 0., 'calls': 0, 'rejected': 0, 'advised': 0}
+            run_state.advisor_costs[self.label or self.__class__.__name__] = costs
+        costs['seconds'] += time.perf_counter() - start
+        costs['calls'] += 1
+        costs['rejected'] += int(rejected)
+        costs['advised'] += int(advice is not None)
+        return advice
+
     @abc.abstractmethod
     def advice(self, rng, run_state, character, oracle):
         pass
@@ -1527,7 +1550,11 @@ class PathAdvisor(Advisor):
 
         if path is not None:
             if self.path_threat_tolerance is not None and path.threat > (self.path_threat_tolerance * character.current_hp):
-                return None
+                # The shortest way is too dangerous, but a roundabout one might not be
+                with run_state.neighborhood.avoiding_threat():
+                    path = self.find_path(rng, run_state, character, oracle)
+                if path is None or path.threat > (self.path_threat_tolerance * character.current_hp):
+                    return None
 
             return ActionAdvice(from_advisor=self, action=path.path_action)
 
@@ -1562,7 +1589,7 @@ class ExcaliburAdvisor(Advisor):
 
 class TravelToAltarAdvisor(Advisor):
     def advice(self, rng, run_state, character, oracle):
-        if not run_state.neighborhood.level_map.altar_map.any():
+        if run_state.neighborhood.level_map.feature_count(gd.get_by_name(gd.CMapGlyph, 'altar')) == 0:
             return None
         unknown = character.inventory.get_items(instance_selector=lambda i: (i.BUC == constants.BUC.unknown and (i.equipped_status is None or i.equipped_status.status != 'worn')))
         if len(unknown) < 5:
@@ -1627,7 +1654,7 @@ class TravelToFountainAdvisorForExcalibur(ExcaliburAdvisor):
         fountains = np.transpose(np.where(lmap.fountain_map))
 
         if len(fountains > 0):
-            nearest_square_idx = np.argmin(np.sum(np.abs(fountains - np.array(run_state.neighborhood.absolute_player_location)), axis=1))
+            nearest_square_idx = lmap.nearest_by_walking_distance(fountains)
             target_square = physics.Square(*fountains[nearest_square_idx])
             menu_plan = menuplan.MenuPlan(
                 "travel to fountain", self, [
@@ -1683,7 +1710,7 @@ class TravelToBespokeUnexploredAdvisor(Advisor):
         ))
 
         if len(desirable_unvisited) > 0:
-            nearest_square_idx = np.argmin(np.sum(np.abs(desirable_unvisited - np.array(run_state.neighborhood.absolute_player_location)), axis=1))
+            nearest_square_idx = lmap.nearest_by_walking_distance(desirable_unvisited)
             self.target_square = physics.Square(*desirable_unvisited[nearest_square_idx])
             if lmap.visits_count_map[self.target_square] != 0:
                 if environment.env.debug:
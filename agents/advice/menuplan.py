@@ -5,6 +5,7 @@ import numpy as np
 from collections import OrderedDict
 
 import environment
+import agents.representation.glyphs as gd
 import agents.representation.inventory as inv
 import agents.representation.physics as physics
 import agents.advice.wish as wish
@@ -16,6 +17,8 @@ from utilities import ARS
 
 class MenuResponse:
     follow_with = None
+    # Responses that type out a known phrase, which the agent can drain without going through generate_action
+    types_phrase = False
     def __init__(self, match_str):
         # Doesn't work in Python 3.6
         # if not isinstance(match_str, str) and not isinstance(match_str, re.Pattern):
@@ -108,27 +111,128 @@ class DirectionMenuResponse(MenuResponse):
 class EndOfSequence(Exception):
     pass
 
+# In getpos, capital letters move the cursor 8 squares
+CURSOR_JUMP = 8
+cursor_jump_actions = {
+    (-1, -1): nethack.actions.CompassDirectionLonger.NW,
+    (-1, 0): nethack.actions.CompassDirectionLonger.N,
+    (-1, 1): nethack.actions.CompassDirectionLonger.NE,
+    (0, -1): nethack.actions.CompassDirectionLonger.W,
+    (0, 1): nethack.actions.CompassDirectionLonger.E,
+    (1, -1): nethack.actions.CompassDirectionLonger.SW,
+    (1, 0): nethack.actions.CompassDirectionLonger.S,
+    (1, 1): nethack.actions.CompassDirectionLonger.SE,
+}
+cursor_jump_deltas = {v:k for k,v in cursor_jump_actions.items()}
+
+# and typing a map symbol moves it to the next square (in reading order, wrapping) with that feature
+cursor_feature_keys = {
+    ord('<'): [gd.get_by_name(gd.CMapGlyph, 'upstair').numeral, gd.get_by_name(gd.CMapGlyph, 'upladder').numeral],
+    ord('>'): [gd.get_by_name(gd.CMapGlyph, 'dnstair').numeral, gd.get_by_name(gd.CMapGlyph, 'dnladder').numeral],
+    ord('_'): [gd.get_by_name(gd.CMapGlyph, 'altar').numeral],
+}
+CURSOR_TO_SELF = ord('@')
+
+# getpos keeps the cursor on map columns 1..COLNO-1 and rows 0..ROWNO-1
+CURSOR_ROWS = range(0, constants.GLYPHS_SHAPE[0])
+CURSOR_COLS = range(1, constants.GLYPHS_SHAPE[1])
+
+def cursor_axis_options(delta, position, cursor_range):
+    # (jumps, steps) along one axis, signed, with CURSOR_JUMP * jumps + steps == delta
+    # Overshooting with one more jump and stepping back is only an option if it keeps the cursor in cursor_range,
+    # since getpos clamps a jump that would leave it (and shortens the other axis of a diagonal to match)
+    sign = int(np.sign(delta))
+    jumps, steps = divmod(abs(delta), CURSOR_JUMP)
+    options = [(sign * jumps, sign * steps)]
+    if steps != 0 and position + sign * (jumps + 1) * CURSOR_JUMP in cursor_range:
+        options.append((sign * (jumps + 1), sign * (steps - CURSOR_JUMP)))
+    return options
+
+def cursor_grid_plan(cursor, target):
+    # Jumps and steps in the two axes pair up into diagonal moves, so the cost is the larger count in each
+    best_cost, best_action = None, None
+    for row_jumps, row_steps in cursor_axis_options(target.row - cursor.row, cursor.row, CURSOR_ROWS):
+        for col_jumps, col_steps in cursor_axis_options(target.col - cursor.col, cursor.col, CURSOR_COLS):
+            cost = max(abs(row_jumps), abs(col_jumps)) + max(abs(row_steps), abs(col_steps))
+            if best_cost is not None and cost >= best_cost:
+                continue
+            best_cost = cost
+            if row_jumps != 0 or col_jumps != 0:
+                best_action = cursor_jump_actions[(int(np.sign(row_jumps)), int(np.sign(col_jumps)))]
+            elif row_steps != 0 or col_steps != 0:
+                best_action = physics.delta_to_action[(int(np.sign(row_steps)), int(np.sign(col_steps)))]
+            else:
+                best_action = None
+    return best_cost, best_action
+
+def next_feature_square(feature_map, cursor, numerals):
+    matches = np.flatnonzero(np.isin(feature_map, numerals))
+    if len(matches) == 0:
+        return None
+    width = feature_map.shape[1]
+    after_cursor = matches[matches > cursor.row * width + cursor.col]
+    landing = after_cursor[0] if len(after_cursor) > 0 else matches[0]
+    return physics.Square(*divmod(int(landing), width))
+
 class TravelNavigationMenuResponse(MenuResponse):
-    def generate_action(self, tty_cursor, target_square):
+    def generate_action(self, tty_cursor, target_square, hero_square=None, feature_map=None):
         if self.exhausted:
             return None
         current_square = physics.Square(*tty_cursor) + physics.Square(-1, 0) # offset because cursor row 0 = top line
 
-        if current_square != target_square:
-            offset = physics.Square(*np.sign(np.array(target_square - current_square)))
-            return physics.delta_to_action[offset]
-        else:
+        if current_square == target_square:
             self.exhausted = True
             return
 
+        if self.expected_square is not None and current_square != self.expected_square:
+            # Our model of the cursor is off (e.g. a monster on the stairs moved a < or > jump),
+            # so fall back to walking it one square at a time
+            self.use_shortcuts = False
+
+        if not self.use_shortcuts:
+            offset = physics.Square(*np.sign(np.array(target_square - current_square)))
+            return physics.delta_to_action[offset]
+
+        cost, action = cursor_grid_plan(current_square, target_square)
+        next_square = None
+        shortcuts = []
+        if hero_square is not None:
+            shortcuts.append((CURSOR_TO_SELF, physics.Square(*hero_square)))
+        if feature_map is not None:
+            for key, numerals in cursor_feature_keys.items():
+                shortcuts.append((key, next_feature_square(feature_map, current_square, numerals)))
+        for key, landing in shortcuts:
+            if landing is None or landing == current_square:
+                continue
+            shortcut_cost = 1 + cursor_grid_plan(landing, target_square)[0]
+            if shortcut_cost < cost:
+                cost, action, next_square = shortcut_cost, key, landing
+
+        if next_square is None:
+            if action in physics.action_to_delta:
+                next_square = current_square + physics.action_to_delta[action]
+            else:
+                row_delta, col_delta = cursor_jump_deltas[action]
+                next_square = current_square + (CURSOR_JUMP * row_delta, CURSOR_JUMP * col_delta)
+        self.expected_square = next_square
+        return action
+
     def __init__(self, match_str, run_state, target_square):
         self.run_state = run_state
         self.target_square = target_square
         self.exhausted = False
+        self.use_shortcuts = True
+        self.expected_square = None
         super().__init__(match_str)
 
     def value(self, message_obj):
-        next_action = self.generate_action(self.run_state.tty_cursor, self.target_square)
+        hero_square = None
+        feature_map = None
+        if self.run_state.current_square is not None:
+            hero_square = self.run_state.current_square.location
+        if self.run_state.neighborhood is not None:
+            feature_map = self.run_state.neighborhood.level_map.dungeon_feature_map
+        next_action = self.generate_action(self.run_state.tty_cursor, self.target_square, hero_square=hero_square, feature_map=feature_map)
         if next_action is not None:
             return next_action
         if "(no travel path)" in message_obj.message or "a boulder" in message_obj.message:
@@ -150,6 +254,8 @@ class ConnectedSequenceMenuResponse(MenuResponse):
             return ord('\r')
 
 class PhraseMenuResponse(MenuResponse):
+    types_phrase = True
+
     def __init__(self, match_str, phrase):
         super().__init__(match_str)
         self.phrase = (c for c in phrase)
@@ -158,13 +264,22 @@ class PhraseMenuResponse(MenuResponse):
         if expect_getline and not message_obj.getline and environment.env.debug:
             pdb.set_trace()
 
+        return self.next_key()
+
+    def next_key(self):
         try:
             next_chr = next(self.phrase)
             return ord(next_chr)
         except StopIteration:
             return ord('\r')
 
+    def still_prompting(self, tty_chars, misc_observation):
+        # Same flags as Message: misc is (yn_question, getline, has_more)
+        return misc_observation[1] == 1 and misc_observation[2] == 0
+
 class WishMenuResponse(MenuResponse):
+    types_phrase = True
+
     def __init__(self, match_str, character, wand=None):
         super().__init__(match_str)
         self.character = character
@@ -175,6 +290,9 @@ class WishMenuResponse(MenuResponse):
         if expect_getline and not message_obj.getline and environment.env.debug:
             pdb.set_trace()
         if environment.env.debug: import pdb; pdb.set_trace()
+        return self.next_key()
+
+    def next_key(self):
         if self.phrase is None:
             wish_obj, wish_string = wish.get_wish(self.character, wand=self.wand)
             self.last_wish = wish_obj
@@ -188,6 +306,9 @@ class WishMenuResponse(MenuResponse):
             self.last_wish = None
             return ord('\r')
 
+    def still_prompting(self, tty_chars, misc_observation):
+        return misc_observation[1] == 1 and misc_observation[2] == 0
+
 class SpecialItemPickupResponse(MenuResponse):
     def __init__(self, character, items):
         self.character = character
@@ -255,6 +376,10 @@ class ExtendedCommandResponse(PhraseMenuResponse):
                 pdb.set_trace()
             return super().value(message_obj, expect_getline=False)
 
+        def still_prompting(self, tty_chars, misc_observation):
+            # The extended command prompt isn't a getline, so look for it on the top line instead
+            return tty_chars[0][0] == ord('#') and misc_observation[2] == 0
+
 class MenuPlan():
     def __init__(self, name, advisor, menu_responses, fallback=None, interactive_menu=None, listening_item=None):
         self.name = name
@@ -265,11 +390,14 @@ class MenuPlan():
         self.current_interactive_menu = None
         self.in_interactive_menu = False
         self.listening_item = listening_item
+        self.typing_response = None
 
     def interact(self, message_obj):
         if message_obj.message is None:
             raise Exception("That's not right")
 
+        self.typing_response = None
+
         if isinstance(self.interactive_menu, list):
             for interactive_menu in self.interactive_menu:
                 if interactive_menu.trigger_phrase in message_obj.message:
@@ -310,6 +438,9 @@ class MenuPlan():
                 if response.follow_with is not None:
                     self.fallback = response.follow_with
 
+                if response.types_phrase:
+                    self.typing_response = response
+
                 if isinstance(self.interactive_menu, list):
                     for interactive_menu in self.interactive_menu:
                         if interactive_menu.trigger_action == action:
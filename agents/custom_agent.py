@@ -268,11 +268,13 @@ class RunState():
         self.log_path = None
         self.target_roles = environment.env.target_roles
         self.respond_to_issue = respond_to_issue
+        # Step latency columns only appear when steps are being timed
+        self.log_header = self.LOG_HEADER + (utilities.STEP_LATENCY_LOG_HEADER if environment.env.time_steps else [])
         if environment.env.log_runs:
             self.log_root = debug_env.savedir
             self.log_path = os.path.join(self.log_root, "log.csv")
             with open(self.log_path, 'w') as log_file:
-                writer = csv.DictWriter(log_file, fieldnames=self.LOG_HEADER)
+                writer = csv.DictWriter(log_file, fieldnames=self.log_header)
                 writer.writeheader()
 
     def print_action_log(self, total):
@@ -281,7 +283,7 @@ class RunState():
     LOG_HEADER = ['race', 'class', 'level', 'exp points', 'depth', 'branch', 'branch_level', 'time', 'hp', 'max_hp', 'AC', 'encumberance', 'hunger', 'message_log', 'action_log', 'wielded_weapon', 'score', 'last_pray_time', 'last_pray_reason', 'scummed', 'ascended', 'step_count', 'l1_advised_step_count', 'l1_need_downstairs_step_count', 'search_efficiency', 'total damage', 'adjacent monster turns', 'died in shop']
     REPLAY_HEADER = ['action', 'run_number', 'dcoord', 'menu_action']
 
-    def log_final_state(self, final_reward, ascended):
+    def log_final_state(self, final_reward, ascended, step_latency=None):
         # self.blstats is intentionally one turn stale, i.e. wasn't updated after done=True was observed
         self.update_reward(final_reward)
         print_stats(True, self, self.blstats)
@@ -295,7 +297,7 @@ class RunState():
         if not self.log_path:
             return
         with open(self.log_path, 'a') as log_file:
-            writer = csv.DictWriter(log_file, fieldnames=self.LOG_HEADER)
+            writer = csv.DictWriter(log_file, fieldnames=self.log_header)
             writer.writerow({
                 'race': self.character.base_race,
                 'class': self.character.base_class,
@@ -325,6 +327,7 @@ class RunState():
                 'total damage': self.total_damage,
                 'adjacent monster turns': self.adjacent_monster_turns,
                 'died in shop': self.neighborhood.in_shop if self.neighborhood else False,
+                **(utilities.step_latency_summary_ms(step_latency) if step_latency and environment.env.time_steps else {}),
             })
 
         with open(os.path.join(self.log_root, 'search_log.csv'), 'a') as search_log_file:
@@ -337,6 +340,11 @@ class RunState():
         message_score_df = pd.DataFrame(self.message_log, columns=['message'], index=pd.Series(self.score_against_message_log, name='score'))
         self.extend_json("final_inventory.json", [str(i) for i in self.character.inventory.all_items()])
         self.extend_json("advisor_counter.json", Counter([advice.from_advisor.__class__.__name__ for advice in self.advice_log if isinstance(advice, ActionAdvice)]))
+        if self.stage_timer.enabled:
+            self.extend_json("stage_timings.json", self.stage_timer.to_dict())
+            self.extend_json("character_memo.json", self.character.derived.to_dict())
+        if self.advisor_costs is not None:
+            self.extend_json("advisor_costs.json", self.advisor_costs)
 
     def extend_json(self, filename, obj):
         import json
@@ -372,6 +380,8 @@ class RunState():
         )
         self.background_menu_plan = background_menu_plan
         self.active_menu_plan = background_menu_plan
+        self.typing_response = None
+        self.glyph_frame = None
         self.message_log = []
         self.score_against_message_log = []
         self.action_log = []
@@ -413,6 +423,9 @@ class RunState():
         self.time_did_advance = True
         self.used_free_stethoscope_move = False
 
+        self.stage_timer = utilities.StageTimer(environment.env.profile_stages)
+        self.advisor_costs = {} if environment.env.profile_stages else None
+
         self.neighborhood = None
         self.current_square = None
         self.failed_move_record = FailedMoveRecords()
@@ -699,8 +712,18 @@ class RunState():
 
     def set_menu_plan(self, menu_plan):
         self.active_menu_plan = menu_plan
+        self.typing_response = None
+
+    def tally_glyph_frame(self):
+        # How many glyph masks this step worked out, and how many requests for them were served from the shared frame
+        if self.glyph_frame is None:
+            return
+        self.stage_timer.tally('glyph_layers_computed', self.glyph_frame.computed)
+        self.stage_timer.tally('glyph_layers_reused', self.glyph_frame.requested - self.glyph_frame.computed)
+        self.glyph_frame = None
 
     def run_menu_plan(self, message):
+        self.typing_response = None
         retval = self.active_menu_plan.interact(message)
 
         if retval is None and self.active_menu_plan.fallback:
@@ -719,8 +742,27 @@ class RunState():
                 #import pdb; pdb.set_trace()
                 # This should have been dealt with by our menu plan
 
+        if retval is not None and retval != ord('\r'):
+            # The rest of the phrase gets typed by next_typed_key
+            self.typing_response = self.active_menu_plan.typing_response
+
         return retval
 
+    def next_typed_key(self, observation):
+        # Keys of a phrase we're partway through typing skip generate_action entirely.
+        # If the screen stops looking like the prompt, we hand back to the full pipeline,
+        # and the menu plan carries on from the same point in the phrase.
+        response = self.typing_response
+        if response is None:
+            return None
+        if not response.still_prompting(observation['tty_chars'], observation['misc']):
+            self.typing_response = None
+            return None
+        key = response.next_key()
+        if key == ord('\r'):
+            self.typing_response = None
+        return key
+
     def update_neighborhood(self, neighborhood):
         self.neighborhood = neighborhood
         if self.current_square.location != neighborhood.absolute_player_location:
@@ -931,6 +973,8 @@ def print_stats(done, run_state, blstats):
 class CustomAgent():
     def __init__(self, debug_env=None, agent_seed=None, respond_to_issue=None):
         self.run_state = RunState(debug_env, agent_seed, respond_to_issue)
+        if self.run_state.advisor_costs is not None:
+            advisor_sets.label_advisors(advisor_sets.new_advisors)
     
     @classmethod
     def generate_action(cls, run_state, observation):
@@ -940,21 +984,28 @@ class CustomAgent():
 
         player_location = (blstats.get('hero_row'), blstats.get('hero_col'))
 
+        stage_timer = run_state.stage_timer
+        # Every consumer of this step's glyphs shares the masks worked out over them
+        glyph_frame = gd.GlyphFrame(observation['glyphs'])
+        run_state.glyph_frame = glyph_frame
+
         if run_state.character:
-            run_state.character.update_inventory_from_observation(
-                run_state.character, blstats.am_hallu(), observation)
+            with stage_timer.stage('inventory'):
+                run_state.character.update_inventory_from_observation(
+                    run_state.character, blstats.am_hallu(), observation)
 
         dungeon_number = blstats.get("dungeon_number")
         level_number = blstats.get("level_number")
         dcoord = DCoord(dungeon_number, level_number)
 
-        try:
-            level_map = run_state.dmap.dlevels[dcoord]
-        except KeyError:
-            level_map = run_state.dmap.make_level_map(dcoord, time, observation['glyphs'], player_location)
+        with stage_timer.stage('dmap'):
+            try:
+                level_map = run_state.dmap.dlevels[dcoord]
+            except KeyError:
+                level_map = run_state.dmap.make_level_map(dcoord, time, glyph_frame, player_location)
 
-        if run_state.character:
-            run_state.dmap.update_target_dcoords(run_state.character)
+            if run_state.character:
+                run_state.dmap.update_target_dcoords(run_state.character)
 
         if not run_state.character and run_state.step_count > 2:
             # The first action should always be to look at attributes
@@ -1017,8 +1068,9 @@ class CustomAgent():
             if run_state.respond_to_issue:
                 run_state.make_issue_response(run_state.respond_to_issue, video_length=40)
 
-        message = Message(observation['message'], observation['tty_chars'], observation['misc'])
-        run_state.handle_message(message)
+        with stage_timer.stage('message'):
+            message = Message(observation['message'], observation['tty_chars'], observation['misc'])
+            run_state.handle_message(message)
 
         if environment.env.log_video:
             run_state.save_frame(message)
@@ -1138,7 +1190,13 @@ class CustomAgent():
         #    import pdb; pdb.set_trace()
 
         last_action_menu = len(run_state.advice_log) != 0 and isinstance(run_state.advice_log[-1], advs.MenuAdvice)
-        level_map.update(changed_level, time, player_location, observation['glyphs'], last_action_menu=last_action_menu)
+        level_map.update_player_location(changed_level, time, player_location, last_action_menu=last_action_menu)
+        # Menu and --More-- steps don't need the glyph-derived layers, so unless this step's own messages
+        # read them we refresh them only once we know we're choosing a real action
+        glyph_maps_current = changed_level or "Something is written here in the dust" in message.message
+        if glyph_maps_current:
+            with stage_timer.stage('level_map_update'):
+                level_map.update_glyph_maps(glyph_frame)
         special_facts = level_map.listen_for_special_engraving(player_location, message.message)
         if special_facts is not None:
             run_state.current_square.special_facts = special_facts
@@ -1213,7 +1271,8 @@ class CustomAgent():
 
         menu_plan_retval = None
         if message:
-            menu_plan_retval = run_state.run_menu_plan(message)
+            with stage_timer.stage('menu_plan'):
+                menu_plan_retval = run_state.run_menu_plan(message)
             ### GET MENU_PLAN RETVAL ###
 
         if menu_plan_retval is None and message.has_more and not run_state.active_menu_plan.in_interactive_menu:
@@ -1221,6 +1280,7 @@ class CustomAgent():
                 keypress=nethack.actions.TextCharacters.SPACE,
                 from_menu_plan=run_state.active_menu_plan, # TODO Not necessarily right vs background
             )
+            stage_timer.count('fast_path')
             return advice
 
         if menu_plan_retval is not None: # wait to return menu_plan retval, in case our click through more is supposed to override behavior in non-interactive menu plan
@@ -1228,8 +1288,13 @@ class CustomAgent():
                 keypress=menu_plan_retval,
                 from_menu_plan=run_state.active_menu_plan, # TODO Not necessarily right vs background
             )
+            stage_timer.count('fast_path')
             return advice
 
+        if not glyph_maps_current:
+            with stage_timer.stage('level_map_update'):
+                level_map.update_glyph_maps(glyph_frame)
+
         if message.has_more or message.yn_question or message.getline:
             if environment.env.debug: import pdb; pdb.set_trace()
             pass
@@ -1292,22 +1357,24 @@ class CustomAgent():
             )
             return advice
 
-        level_map.garbage_collect_corpses(time)
-        run_state.failed_move_record.garbage_collect(time)
+        with stage_timer.stage('garbage_collect'):
+            level_map.garbage_collect_corpses(time)
+            run_state.failed_move_record.garbage_collect(time)
 
         if run_state.current_square.elbereth and run_state.current_square.elbereth.looked_for_it:
             run_state.current_square.elbereth = None
 
-        neighborhood = Neighborhood(
-            time,
-            run_state.current_square,
-            run_state.failed_move_record,
-            observation['glyphs'],
-            level_map,
-            run_state.character,
-            run_state.latest_monster_flight,
-            blstats.am_hallu(),
-        )
+        with stage_timer.stage('neighborhood'):
+            neighborhood = Neighborhood(
+                time,
+                run_state.current_square,
+                run_state.failed_move_record,
+                glyph_frame,
+                level_map,
+                run_state.character,
+                run_state.latest_monster_flight,
+                blstats.am_hallu(),
+            )
         if not (run_state.last_non_menu_action_failed_advancement or run_state.last_non_menu_action == nethack.actions.Command.SEARCH):
             run_state.check_gamestate_advancement(neighborhood)
 
@@ -1340,18 +1407,19 @@ class CustomAgent():
 
         oracle = advs.Oracle(run_state, run_state.character, neighborhood, message, blstats)
 
-        for advisor in advisor_sets.new_advisors:
-            advice = advisor.advice_on_conditions(run_state.rng, run_state, run_state.character, oracle)
-            if advice is not None:
-                #print(advice)
-                if advice.action == nethack.actions.Command.PRAY:
-                    run_state.character.last_pray_time = time
-                    run_state.character.last_pray_reason = advice.from_advisor # advice.from_advisor because we want to be more specific inside composite advisors
-                elif advice.action == nethack.actions.Command.SEARCH:
-                    level_map.log_search(player_location)
+        with stage_timer.stage('advisors'):
+            for advisor in advisor_sets.new_advisors:
+                advice = advisor.advice_on_conditions(run_state.rng, run_state, run_state.character, oracle)
+                if advice is not None:
+                    #print(advice)
+                    if advice.action == nethack.actions.Command.PRAY:
+                        run_state.character.last_pray_time = time
+                        run_state.character.last_pray_reason = advice.from_advisor # advice.from_advisor because we want to be more specific inside composite advisors
+                    elif advice.action == nethack.actions.Command.SEARCH:
+                        level_map.log_search(player_location)
 
-                if advice.action not in run_state.actions_without_consequence:
-                    break
+                    if advice.action not in run_state.actions_without_consequence:
+                        break
 
         if isinstance(advice.from_advisor, advs.FallbackSearchAdvisor):
             #if environment.env.debug: import pdb; pdb.set_trace()
@@ -1382,7 +1450,16 @@ class CustomAgent():
         self.run_state.update_reward(reward)
         self.run_state.log_tty_cursor(observation['tty_cursor'])
 
-        advice = self.generate_action(self.run_state, observation)
+        typed_key = self.run_state.next_typed_key(observation)
+        if typed_key is not None:
+            advice = MenuAdvice(keypress=typed_key, from_menu_plan=self.run_state.active_menu_plan)
+            self.run_state.log_action(advice)
+            self.run_state.log_position()
+            return utilities.ACTION_LOOKUP[typed_key]
+
+        with self.run_state.stage_timer.stage('generate_action'):
+            advice = self.generate_action(self.run_state, observation)
+        self.run_state.tally_glyph_frame()
 
         if not isinstance(advice, Advice):
             raise Exception("Bad advice")
@@ -1401,3 +1478,28 @@ class CustomAgent():
             return utilities.ACTION_LOOKUP[advice.action]
         else:
             return utilities.ACTION_LOOKUP[advice.keypress]
+
+
+class BatchedCustomAgent(BatchedAgent):
+    """
+    Drives several environments from one process with one CustomAgent, and so one RunState, per env.
+    Spoilers, glyph lookups and special levels are module level and shared between them.
+    """
+    def __init__(self, num_envs, num_actions, debug_envs=None):
+        super().__init__(num_envs, num_actions, debug_envs)
+        self.agents = [CustomAgent(debug_envs[i] if debug_envs else None) for i in range(num_envs)]
+
+    def step_env(self, env_index, observation, reward, done, info):
+        return self.agents[env_index].step(observation, reward, done, info)
+
+    def batched_step(self, observations, rewards, dones, infos):
+        actions = []
+        for i, (observation, reward, done, info) in enumerate(zip(observations, rewards, dones, infos)):
+            if done:
+                # The env has already been reset, so this observation starts the next episode
+                run_state = self.agents[i].run_state
+                run_state.log_final_state(reward, info.get("is_ascended", False))
+                run_state.reset()
+                reward = 0
+            actions.append(self.step_env(i, observation, reward, done, info))
+        return actions
@@ -16,6 +16,7 @@ import agents.representation.threat as threat
 import agents.advice.preferences as preferences
 
 from utilities import ARS
+from utilities import VersionedMemo
 
 @dataclass
 class HeldBy():
@@ -23,6 +24,12 @@ class HeldBy():
     monster_glyph: gd.MonsterGlyph
     #monster_square: Tuple[int, int]
 
+class TussleTable(NamedTuple):
+    active_damage: np.ndarray
+    active_danger_from_types: np.ndarray
+    lingering_damage: np.ndarray
+    death_danger_from_types: np.ndarray
+
 @dataclass
 class Character():
     base_race: str
@@ -59,6 +66,19 @@ class Character():
     wish_in_progress: tuple = None
     blinding_attempts: dict = field(default_factory=dict)
     spells: list =  field(default_factory=list)
+    version: int = 0
+    derived: VersionedMemo = field(default_factory=VersionedMemo, repr=False)
+
+    # Fields that everything in derived is computed from. Assigning a new value to any of them bumps version
+    versioned_fields = frozenset(['AC', 'experience_level', 'innate_intrinsics', 'noninnate_intrinsics', 'inventory', 'attributes'])
+
+    def __setattr__(self, name, value):
+        if name in self.versioned_fields and getattr(self, name, None) != value:
+            object.__setattr__(self, 'version', getattr(self, 'version', 0) + 1)
+        object.__setattr__(self, name, value)
+
+    def memoized(self, name, compute):
+        return self.derived.get(self.version, name, compute)
 
     def set_class_skills(self):
         self.class_skills = constants.CLASS_SKILLS[self.base_class.value].to_dict()
@@ -102,12 +122,16 @@ class Character():
             new_intrinsics = new_intrinsics | race_intrinsics | role_intrinsics
         self.innate_intrinsics = new_intrinsics
 
-    def has_intrinsic(self, intrinsic):
+    def intrinsics(self):
+        return self.memoized('intrinsics', self.calculate_intrinsics)
+
+    def calculate_intrinsics(self):
         if self.inventory is None:
-            intrinsics = (self.innate_intrinsics | self.noninnate_intrinsics)
-        else:
-            intrinsics = (self.innate_intrinsics | self.noninnate_intrinsics | self.inventory.extrinsics)
-        return bool(intrinsics & intrinsic)
+            return self.innate_intrinsics | self.noninnate_intrinsics
+        return self.innate_intrinsics | self.noninnate_intrinsics | self.inventory.extrinsics
+
+    def has_intrinsic(self, intrinsic):
+        return bool(self.intrinsics() & intrinsic)
 
     def resists(self, damage_type):
         relevant_resistances = threat.threat_to_resist.get(damage_type, [])
@@ -119,6 +143,9 @@ class Character():
         return False
 
     def speed(self):
+        return self.memoized('speed', self.calculate_speed)
+
+    def calculate_speed(self):
         # TK know about burden
         if self.has_intrinsic(constants.Intrinsics.extrinsic_speed):
             return 20
@@ -302,6 +329,42 @@ class Character():
     def garbage_collect_camera_shots(self, time):
         self.blinding_attempts = {k:v for k,v in self.blinding_attempts.items() if v >= time - 10}
 
+    def tussle_table(self):
+        return self.memoized('tussle_table', self.calculate_tussle_table)
+
+    def calculate_tussle_table(self):
+        # The parts of MonsterSpoiler.char_would_tussle_with that don't depend on current hp, one row per monster glyph.
+        # Taking the larger damage first is fine because evaluate_threat_damage only goes up with damage
+        spoilers = [gd.GLYPH_NUMERAL_LOOKUP[numeral].monster_spoiler for numeral in gd.MonsterGlyph.numerals()]
+        danger_by_types = {}
+        def danger_from_types(damage):
+            # only a few distinct combinations of threat types come up across all monsters
+            if damage.threat_type not in danger_by_types:
+                danger_by_types[damage.threat_type] = threat.evaluate_threat_type(damage, self)
+            return danger_by_types[damage.threat_type]
+
+        active_damage, active_danger_from_types, lingering_damage, death_danger_from_types = [], [], [], []
+        for spoiler in spoilers:
+            ranged = spoiler.expected_ranged_damage_to_character(self)
+            melee = spoiler.expected_melee_damage_to_character(self)
+            death = spoiler.expected_death_damage_to_character(self)
+            active_damage.append(max(ranged.damage, melee.damage))
+            active_danger_from_types.append(max(danger_from_types(ranged), danger_from_types(melee)))
+            lingering_damage.append(max(spoiler.expected_passive_damage_to_character(self).damage, death.damage))
+            death_danger_from_types.append(danger_from_types(death))
+        return TussleTable(*(np.array(column) for column in (active_damage, active_danger_from_types, lingering_damage, death_danger_from_types)))
+
+    def unmeleeable_glyphs(self):
+        # Over every glyph numeral, whether it's a monster we wouldn't tussle with at our current hp
+        table = self.tussle_table()
+        active_danger = np.maximum(table.active_danger_from_types, threat.evaluate_threat_damages(table.active_damage, self))
+        cumulative_safety = np.maximum(table.death_danger_from_types, threat.evaluate_threat_damages(table.lingering_damage, self))
+        would_tussle = (active_danger > threat.CharacterThreat.safe) | (cumulative_safety < threat.CharacterThreat.high)
+
+        unmeleeable = np.full(len(gd.ALL_GLYPH_NUMERALS), False)
+        unmeleeable[gd.MonsterGlyph.OFFSET:gd.MonsterGlyph.OFFSET + gd.MonsterGlyph.COUNT] = ~would_tussle
+        return unmeleeable
+
     def scared_by(self, monster):
         if isinstance(monster, gd.InvisibleGlyph):
             return True
@@ -50,6 +50,23 @@ for _, row in corpse_df.iterrows():
     normalized = CorpseSpoiler(**normalized_dict)
     CORPSES_BY_NAME[normalized.name] = normalized
 
+ALL_GLYPH_NUMERALS = np.arange(nethack.MAX_GLYPH + 1)
+
+def glyph_lookup(offset=0):
+    # Evaluates a mask function over every glyph numeral once, on first use, and answers later calls
+    # with a single fancy index into that table. offset is for masks written in terms of numeral - offset
+    def decorator(mask_function):
+        table = None
+        @functools.wraps(mask_function)
+        def lookup(*args):
+            nonlocal table
+            *bound, values = args
+            if table is None:
+                table = mask_function(*bound, ALL_GLYPH_NUMERALS - offset)
+            return table[np.asarray(values, dtype=np.intp) + offset]
+        return lookup
+    return decorator
+
 class Glyph():
     OFFSET = 0
     COUNT = 0
@@ -175,6 +192,7 @@ class MonsterGlyph(MonsterAlikeGlyph):
         return (numerals == nethack.GLYPH_MON_OFF + 28)
 
     @staticmethod
+    @glyph_lookup()
     def always_peaceful_mask(numerals):
         return (numerals == nethack.GLYPH_MON_OFF + 267) | (numerals  == nethack.GLYPH_MON_OFF + 270) | ((numerals > (nethack.GLYPH_MON_OFF + 277)) & (numerals < (280 + nethack.GLYPH_MON_OFF)))
 
@@ -442,10 +460,12 @@ class CMapGlyph(Glyph):
         'sw_br', # 86
     ]
     @classmethod
+    @glyph_lookup()
     def class_mask_without_stone(cls, glyphs):
         return (glyphs >= cls.OFFSET + 1) & (glyphs < cls.OFFSET + cls.COUNT)
 
     @classmethod
+    @glyph_lookup(offset=OFFSET)
     def is_poorly_understood_check(cls, offsets):
         # Christian: Glyphs that I don't really know what they are
         return (
@@ -455,6 +475,7 @@ class CMapGlyph(Glyph):
         )
 
     @classmethod
+    @glyph_lookup(offset=OFFSET)
     def is_room_floor_check(cls, offsets):
         # This is specifically defined as the stuff you find
         # in the guts of a DoD room. Used to define special rooms
@@ -464,6 +485,7 @@ class CMapGlyph(Glyph):
         )
 
     @classmethod
+    @glyph_lookup(offset=OFFSET)
     def is_trap_to_avoid_check(cls, offsets):
         return (
             ((offsets >= 42) & (offsets <= 63)) &
@@ -471,6 +493,7 @@ class CMapGlyph(Glyph):
         )
 
     @classmethod
+    @glyph_lookup(offset=OFFSET)
     def is_safely_walkable_check(cls, offsets):
          return (
              ~((offsets < 0) | (offsets > cls.OFFSET + cls.COUNT)) &
@@ -481,42 +504,52 @@ class CMapGlyph(Glyph):
          )
 
     @staticmethod
+    @glyph_lookup(offset=OFFSET)
     def is_liquid_check(offsets):
         return (offsets == 41) | (offsets == 32) | (offsets == 34)
 
     @staticmethod
+    @glyph_lookup(offset=OFFSET)
     def is_door_check(offsets):
         return (offsets >= 12) & (offsets <= 16)
 
     @staticmethod
+    @glyph_lookup(offset=OFFSET)
     def is_wall_check(offsets):
         return (offsets < 12)
 
     @staticmethod
+    @glyph_lookup(offset=OFFSET)
     def is_observed_wall_check(offsets):
         return (offsets > 0) & (offsets < 12)
 
     @staticmethod
+    @glyph_lookup(offset=OFFSET)
     def is_possible_secret_check(offsets):
         return (offsets >= 0) & (offsets < 3)
 
     @staticmethod
+    @glyph_lookup()
     def possible_secret_mask(numerals):
         return (numerals >= nethack.GLYPH_CMAP_OFF) & (numerals < 3 + nethack.GLYPH_CMAP_OFF)
 
     @staticmethod
+    @glyph_lookup()
     def open_door_mask(numerals):
         return (numerals > 12 + nethack.GLYPH_CMAP_OFF) & (numerals < 15 + nethack.GLYPH_CMAP_OFF)
 
     @classmethod
+    @glyph_lookup()
     def wall_mask(cls, numerals):
         return (numerals >= nethack.GLYPH_CMAP_OFF) & (numerals < nethack.GLYPH_CMAP_OFF + 12)
 
     @staticmethod
+    @glyph_lookup()
     def closed_door_mask(numerals):
         return (numerals >= 15 + nethack.GLYPH_CMAP_OFF) & (numerals < 17 + nethack.GLYPH_CMAP_OFF)
 
     @staticmethod
+    @glyph_lookup()
     def tactical_square_mask(numerals):
         return (numerals >= 21 + nethack.GLYPH_CMAP_OFF) & (numerals <= 26 + nethack.GLYPH_CMAP_OFF)
 
@@ -623,6 +656,7 @@ class StatueGlyph(Glyph):
     def __init__(self, numeral):
         super().__init__(numeral)
 
+@glyph_lookup()
 def walkable(glyphs):
     # Object, Statue, Pet, Corpse, CMap
     walkable_glyphs = np.full_like(glyphs, False, dtype=bool)
@@ -1605,6 +1639,7 @@ def get_by_name(klass, name):
         raise Exception(f"bad glyph name: {name}")
     return glyph
 
+@glyph_lookup()
 def stackable_mask(numerals):
     return ObjectGlyph.class_mask(numerals) | CorpseGlyph.class_mask(numerals) | StatueGlyph.class_mask(numerals)
 
@@ -1614,9 +1649,70 @@ def stackable_glyph(glyph):
     if isinstance(glyph, StatueGlyph): return True
     return False
 
+@glyph_lookup()
 def monster_like_mask(numerals):
     return MonsterGlyph.class_mask(numerals) | InvisibleGlyph.class_mask(numerals) | SwallowGlyph.class_mask(numerals) | WarningGlyph.class_mask(numerals)
 
+class GlyphFrame():
+    # One step's glyphs and the semantic layers over them. Each layer is worked out at most once, when first asked for,
+    # and handed out read-only so the map, neighborhood and threat code can share it
+    LAYERS = {
+        'cmap_without_stone': CMapGlyph.class_mask_without_stone,
+        'possible_secret': CMapGlyph.possible_secret_mask,
+        'open_door': CMapGlyph.open_door_mask,
+        'closed_door': CMapGlyph.closed_door_mask,
+        'wall': CMapGlyph.wall_mask,
+        'tactical_square': CMapGlyph.tactical_square_mask,
+        'walkable': walkable,
+        'stackable': stackable_mask,
+        'monster_like': monster_like_mask,
+        'monster': MonsterGlyph.class_mask,
+        'always_peaceful': MonsterGlyph.always_peaceful_mask,
+        'shopkeeper': MonsterGlyph.shopkeeper_mask,
+        'pet': PetGlyph.class_mask,
+        'invisible': InvisibleGlyph.class_mask,
+        'object': ObjectGlyph.class_mask,
+        'random_class': RandomClassGlyph.class_mask,
+        'boulder': RockGlyph.boulder_mask,
+    }
+
+    def __init__(self, glyphs):
+        self.glyphs = glyphs
+        self.layers = {}
+        self.requested = 0
+        self.computed = 0
+
+    @classmethod
+    def of(cls, glyphs):
+        # Lets callers hand over either a frame (or a view of one) or a bare glyph array
+        if isinstance(glyphs, (GlyphFrame, GlyphFrameView)):
+            return glyphs
+        return cls(glyphs)
+
+    def layer(self, name):
+        self.requested += 1
+        try:
+            return self.layers[name]
+        except KeyError:
+            self.computed += 1
+            layer = self.LAYERS[name](self.glyphs)
+            layer.flags.writeable = False
+            self.layers[name] = layer
+            return layer
+
+    def view(self, window):
+        return GlyphFrameView(self, window)
+
+class GlyphFrameView():
+    # A window onto a GlyphFrame, for consumers that only look at part of the map
+    def __init__(self, frame, window):
+        self.frame = frame
+        self.window = window
+        self.glyphs = frame.glyphs[window]
+
+    def layer(self, name):
+        return self.frame.layer(name)[self.window]
+
 #for k,v in MonsterGlyph.numeral_mapping().items():
 #    print(k, v)
 #print(MonsterGlyph.OFFSET)
@@ -6,11 +6,13 @@ import json
 import os
 
 import numpy as np
-import scipy.signal
+import scipy.sparse
+import scipy.sparse.csgraph
 
 import environment
 import agents.representation.glyphs as gd
 import agents.representation.inventory as inventory
+import agents.representation.morphology as morphology
 import agents.representation.physics as physics
 import utilities
 import agents.representation.constants as constants
@@ -227,16 +229,17 @@ class DLevelMap():
     def glyphs_to_dungeon_features(glyphs, prior):
         # This treats the gd.CMapGlyph.OFFSET as unobserved. No way, AFAICT, to
         # distinguish between solid stone that we've seen with our own eyes vs. not
+        frame = gd.GlyphFrame.of(glyphs)
 
         dungeon_features = np.where(
-            gd.CMapGlyph.class_mask_without_stone(glyphs),
-            glyphs,
+            frame.layer('cmap_without_stone'),
+            frame.glyphs,
             prior
-        )
+        ).astype(int, copy=False)
 
         # our prior for monsters and objects is room floor
         #import pdb; pdb.set_trace()
-        dungeon_features[(dungeon_features == 0) & ((gd.MonsterGlyph.class_mask(glyphs)) | (gd.ObjectGlyph.class_mask(glyphs)))] = gd.CMapGlyph.OFFSET + 19
+        dungeon_features[(dungeon_features == 0) & (frame.layer('monster') | frame.layer('object'))] = gd.CMapGlyph.OFFSET + 19
         return dungeon_features
 
     def __init__(self, special_level_searcher, dcoord, time):
@@ -249,6 +252,9 @@ class DLevelMap():
 
         self.downstairs_count = 0
         self.upstairs_count = 0
+        # How many squares of dungeon_feature_map hold each glyph numeral, kept in step with every write to it
+        self.feature_counts = np.zeros(gd.ALL_GLYPH_NUMERALS.size, dtype=int)
+        self.feature_counts[0] = np.prod(constants.GLYPHS_SHAPE)
         self.downstairs_target = 1
         self.upstairs_target = 1
 
@@ -275,6 +281,19 @@ class DLevelMap():
         self.traps_to_avoid = np.full(constants.GLYPHS_SHAPE, False, dtype='bool')
         self.embedded_object_map = np.full(constants.GLYPHS_SHAPE, False, dtype='bool')
 
+        self.distance_field_cache = None
+
+        # What the glyph-derived layers were last worked out from, so the next update only revisits squares that changed
+        self.last_glyphs = None
+        self.derived_feature_map = None
+        self.derived_special_level = None
+        self.verify_incremental_updates = environment.env.verify_map_updates
+
+        # Connected components of room floor, relabelled only when the room floor changes
+        self.room_labels = np.zeros(constants.GLYPHS_SHAPE, dtype=int)
+        self.labelled_room_floor = np.full(constants.GLYPHS_SHAPE, False, dtype='bool')
+        self.special_rooms_need_expanding = False
+
         self.staircases = {}
         self.edible_corpse_dict = defaultdict(list)
         self.warning_engravings = {}
@@ -313,13 +332,16 @@ class DLevelMap():
     def need_egress(self):
         return (self.downstairs_count < self.downstairs_target) or (self.upstairs_count < self.upstairs_target)
 
+    def feature_count(self, *glyphs):
+        return sum(self.feature_counts[glyph.numeral] for glyph in glyphs)
+
+    def count_feature_changes(self, squares, old_features, new_features):
+        np.subtract.at(self.feature_counts, old_features[squares], 1)
+        np.add.at(self.feature_counts, new_features[squares], 1)
+
     def update_stair_counts(self):
-        if self.need_egress():
-            # If we're missing stairs let's count and try to find them
-            unique, counts = np.unique(self.dungeon_feature_map, return_counts=True)
-            counted_elements = dict(zip(unique, counts))
-            self.upstairs_count = counted_elements.get(gd.get_by_name(gd.CMapGlyph, 'upstair').numeral, 0)
-            self.downstairs_count = counted_elements.get(gd.get_by_name(gd.CMapGlyph, 'dnstair').numeral, 0)
+        self.upstairs_count = self.feature_count(gd.get_by_name(gd.CMapGlyph, 'upstair'))
+        self.downstairs_count = self.feature_count(gd.get_by_name(gd.CMapGlyph, 'dnstair'))
         if self.upstairs_count > self.upstairs_target:
             print(f"Found a branch at {self.dcoord}")
             self.upstairs_target = self.upstairs_count
@@ -328,51 +350,14 @@ class DLevelMap():
             self.downstairs_target = self.downstairs_count
     
     def update(self, changed_level, time, player_location, glyphs, last_action_menu=False):
+        self.update_player_location(changed_level, time, player_location, last_action_menu=last_action_menu)
+        self.update_glyph_maps(glyphs)
 
+    def update_player_location(self, changed_level, time, player_location, last_action_menu=False):
+        # Cheap enough to do every step, including menu and --More-- steps
         if changed_level:
             self.time_of_recent_arrival = time
 
-        self.dungeon_feature_map = self.glyphs_to_dungeon_features(glyphs, self.dungeon_feature_map)
-
-        self.boulder_map = (glyphs == gd.RockGlyph.OFFSET)
-        self.obvious_mimics = gd.RandomClassGlyph.class_mask(glyphs)
-        if self.dcoord.branch == Branches.Sokoban and self.special_level is not None:
-            self.obvious_mimics |= ~self.sokoban_boulders & self.boulder_map
-
-        # Basic terrain types
-
-        offsets = np.where(
-            self.dungeon_feature_map != 0,
-            self.dungeon_feature_map - gd.CMapGlyph.OFFSET,
-            0 # solid stone / unseen
-        )
-
-        self.walls = gd.CMapGlyph.is_wall_check(offsets)
-        self.observed_walls = gd.CMapGlyph.is_observed_wall_check(offsets)
-        self.room_floor = gd.CMapGlyph.is_room_floor_check(offsets)
-        self.safely_walkable = gd.CMapGlyph.is_safely_walkable_check(offsets)
-        self.doors = gd.CMapGlyph.is_door_check(offsets)
-        self.traps_to_avoid = gd.CMapGlyph.is_trap_to_avoid_check(offsets)
-        if self.special_level:
-            self.traps_to_avoid |= self.special_level.traps_to_avoid
-        self.fountain_map = (offsets == 31)
-        self.altar_map = (offsets == 27)
-
-        # Solid stone and fog of war both show up here
-        self.fog_of_war = (offsets == 0)
-        adjacent_to_fog = FloodMap.flood_one_level_from_mask(self.fog_of_war)
-
-        # once we're happy with our Sokoban performance and don't need to seed, switch this to using the dungeon feature map
-        self.possible_secrets = gd.CMapGlyph.is_possible_secret_check(glyphs - gd.CMapGlyph.OFFSET)
-        if self.special_level is not None:
-            self.possible_secrets &= self.special_level.potential_secret_doors
-
-        if np.count_nonzero(gd.CMapGlyph.is_poorly_understood_check(offsets)):
-            if environment.env.debug: import pdb; pdb.set_trace()
-            pass
-
-        # This is expensive. If we don't get long-term utility from these, should delete it
-        self.update_stair_counts()
         old_player_location = self.player_location
         self.player_location = player_location
         if self.visits_count_map[self.player_location] == 0:
@@ -388,15 +373,48 @@ class DLevelMap():
         self.player_location_mask[old_player_location] = False
         self.player_location_mask[player_location] = True
 
+    def update_glyph_maps(self, glyphs):
+        # The expensive part of the update. Layers derived from the glyphs only need to be current
+        # when we are choosing a real action, so menu and --More-- steps can leave them a step stale
+        player_location = self.player_location
+        frame = gd.GlyphFrame.of(glyphs)
+
+        self.boulder_map = frame.layer('boulder')
+        self.obvious_mimics = frame.layer('random_class')
+        if self.dcoord.branch == Branches.Sokoban and self.special_level is not None:
+            self.obvious_mimics = self.obvious_mimics | (~self.sokoban_boulders & self.boulder_map)
+
+        prior_feature_map = self.dungeon_feature_map
+        incremental = self.last_glyphs is not None and self.derived_special_level is self.special_level
+        if incremental:
+            layers = self.incremental_glyph_layers(frame, prior_feature_map)
+        else:
+            layers = self.full_glyph_layers(frame, prior_feature_map)
+        changed_features = np.nonzero(layers['dungeon_feature_map'] != prior_feature_map)
+        self.count_feature_changes(changed_features, prior_feature_map, layers['dungeon_feature_map'])
+        for name, layer in layers.items():
+            setattr(self, name, layer)
+        if incremental and self.verify_incremental_updates:
+            self.verify_glyph_layers(self.full_glyph_layers(frame, prior_feature_map))
+
+        self.last_glyphs = frame.glyphs.copy()
+        self.derived_feature_map = self.dungeon_feature_map.copy()
+        self.derived_special_level = self.special_level
+
+        self.update_stair_counts()
+
+        self.update_room_labels()
 
         # flood special rooms in case new squares have been discovered
-        for special_room_type in constants.SpecialRoomTypes:
-            if special_room_type != constants.SpecialRoomTypes.NONE:
-                room_mask = self.special_room_map == special_room_type.value
-                if not room_mask.any():
-                    continue
-                expanded_mask = self.expand_mask_along_room_floor(room_mask)
-                self.add_room(expanded_mask, special_room_type)
+        if self.special_rooms_need_expanding:
+            for special_room_type in constants.SpecialRoomTypes:
+                if special_room_type != constants.SpecialRoomTypes.NONE:
+                    room_mask = self.special_room_map == special_room_type.value
+                    if not room_mask.any():
+                        continue
+                    expanded_mask = self.expand_mask_along_room_floor(room_mask)
+                    self.add_room(expanded_mask, special_room_type)
+            self.special_rooms_need_expanding = False
 
         reachable = (
             (self.safely_walkable | self.doors) &
@@ -408,7 +426,7 @@ class DLevelMap():
         self.frontier_squares = (
             (self.visits_count_map == 0) &
             reachable &
-            (adjacent_to_fog)
+            (self.adjacent_to_fog)
         )
 
         self.clear = (np.count_nonzero(self.frontier_squares & ~self.exhausted_travel_map) == 0)
@@ -425,17 +443,126 @@ class DLevelMap():
                     self.sokoban_move_index = 0
                     self.solved = False
 
-    def expand_mask_along_room_floor(self, mask):
-        while True:
-            new_mask = FloodMap.flood_one_level_from_mask(mask)
-            new_mask = new_mask & self.room_floor
+    def feature_layers(self, dungeon_features, where):
+        # Layers that are a function of each square's dungeon feature alone, for the squares at where
+        # (index arrays from np.nonzero, or slice(None) for the whole map)
+        offsets = np.where(
+            dungeon_features != 0,
+            dungeon_features - gd.CMapGlyph.OFFSET,
+            0 # solid stone / unseen
+        )
+        if np.count_nonzero(gd.CMapGlyph.is_poorly_understood_check(offsets)):
+            if environment.env.debug: import pdb; pdb.set_trace()
+            pass
 
-            if (new_mask == mask).all():
-                break
-            else:
-                mask = new_mask
+        traps_to_avoid = gd.CMapGlyph.is_trap_to_avoid_check(offsets)
+        if self.special_level:
+            traps_to_avoid |= self.special_level.traps_to_avoid[where]
+
+        return {
+            'walls': gd.CMapGlyph.is_wall_check(offsets),
+            'observed_walls': gd.CMapGlyph.is_observed_wall_check(offsets),
+            'room_floor': gd.CMapGlyph.is_room_floor_check(offsets),
+            'safely_walkable': gd.CMapGlyph.is_safely_walkable_check(offsets),
+            'doors': gd.CMapGlyph.is_door_check(offsets),
+            'traps_to_avoid': traps_to_avoid,
+            'fountain_map': (offsets == 31),
+            'altar_map': (offsets == 27),
+            # Solid stone and fog of war both show up here
+            'fog_of_war': (offsets == 0),
+        }
 
-        return mask
+    def possible_secrets_at(self, glyphs, where):
+        # once we're happy with our Sokoban performance and don't need to seed, switch this to using the dungeon feature map
+        possible_secrets = gd.GlyphFrame.of(glyphs).layer('possible_secret')
+        if self.special_level is not None:
+            possible_secrets = possible_secrets & self.special_level.potential_secret_doors[where]
+        return possible_secrets
+
+    def full_glyph_layers(self, frame, prior_feature_map):
+        dungeon_feature_map = self.glyphs_to_dungeon_features(frame, prior_feature_map)
+        everywhere = slice(None)
+        layers = self.feature_layers(dungeon_feature_map, everywhere)
+        layers['dungeon_feature_map'] = dungeon_feature_map
+        layers['possible_secrets'] = self.possible_secrets_at(frame, everywhere)
+        layers['adjacent_to_fog'] = morphology.dilate(layers['fog_of_war'])
+        return layers
+
+    def incremental_glyph_layers(self, frame, prior_feature_map):
+        # Only squares whose glyph changed, or whose feature was set directly (e.g. by add_feature), can change.
+        # Returns just the layers that did
+        touched = np.nonzero((frame.glyphs != self.last_glyphs) | (prior_feature_map != self.derived_feature_map))
+        dungeon_feature_map = prior_feature_map.copy()
+        if len(touched[0]) > 0:
+            dungeon_feature_map[touched] = self.glyphs_to_dungeon_features(frame.glyphs[touched], prior_feature_map[touched])
+        layers = {'dungeon_feature_map': dungeon_feature_map}
+
+        changed = np.nonzero(dungeon_feature_map != self.derived_feature_map)
+        if len(changed[0]) > 0:
+            for name, values in self.feature_layers(dungeon_feature_map[changed], changed).items():
+                layers[name] = getattr(self, name).copy()
+                layers[name][changed] = values
+
+            # Fog adjacency can change for the changed squares and anything next to them
+            rows, cols = FloodMap.squares_around(changed, dungeon_feature_map.shape)
+            padded_fog = np.full((dungeon_feature_map.shape[0] + 2, dungeon_feature_map.shape[1] + 2), False)
+            padded_fog[1:-1, 1:-1] = layers['fog_of_war']
+            adjacent_to_fog = np.full(len(rows), False)
+            for dr in (-1, 0, 1):
+                for dc in (-1, 0, 1):
+                    adjacent_to_fog |= padded_fog[rows + 1 + dr, cols + 1 + dc]
+            layers['adjacent_to_fog'] = self.adjacent_to_fog.copy()
+            layers['adjacent_to_fog'][rows, cols] = adjacent_to_fog
+
+        if len(touched[0]) > 0:
+            layers['possible_secrets'] = self.possible_secrets.copy()
+            layers['possible_secrets'][touched] = self.possible_secrets_at(frame.glyphs[touched], touched)
+        return layers
+
+    def verify_glyph_layers(self, expected_layers):
+        for name, expected in expected_layers.items():
+            if not np.array_equal(getattr(self, name), expected):
+                if environment.env.debug: import pdb; pdb.set_trace()
+                raise Exception(f"Incremental update of {name} diverged from a full recompute")
+        if not np.array_equal(self.feature_counts, np.bincount(self.dungeon_feature_map.ravel(), minlength=self.feature_counts.size)):
+            if environment.env.debug: import pdb; pdb.set_trace()
+            raise Exception("Feature counts diverged from the dungeon feature map")
+
+    def distance_field(self):
+        # Walking distance from the player to every square, -1 where we know no way there.
+        # Only recomputed when the player or the walkable squares have changed since the last call
+        walkable = (self.safely_walkable | self.doors) & ~self.boulder_map & ~self.embedded_object_map
+        if self.distance_field_cache is not None:
+            location, cached_walkable, distances = self.distance_field_cache
+            if location == self.player_location and np.array_equal(cached_walkable, walkable):
+                return distances
+
+        distances = FloodMap.walking_distances(
+            self.player_location, walkable, self.doors, diagonal=self.dcoord.branch != Branches.Sokoban)
+        self.distance_field_cache = (self.player_location, walkable, distances)
+        return distances
+
+    def nearest_by_walking_distance(self, squares):
+        # Index of the nearest of squares (an N x 2 array) that we know how to walk to. If we know a way to
+        # none of them, fall back to the nearest by Manhattan distance and let NetHack's travel try its luck
+        distances = self.distance_field()[squares[:, 0], squares[:, 1]]
+        reachable = distances >= 0
+        if reachable.any():
+            return np.argmin(np.where(reachable, distances, np.iinfo(distances.dtype).max))
+        return np.argmin(np.sum(np.abs(squares - np.array(self.player_location)), axis=1))
+
+    def update_room_labels(self):
+        if self.room_floor is self.labelled_room_floor:
+            return
+        # Special rooms can only grow if a component of room floor gained squares
+        if (self.room_floor & ~self.labelled_room_floor).any():
+            self.special_rooms_need_expanding = True
+        self.room_labels, _ = morphology.label_components(self.room_floor)
+        self.labelled_room_floor = self.room_floor
+
+    def expand_mask_along_room_floor(self, mask):
+        self.update_room_labels()
+        return morphology.flood_fill(mask, self.room_floor, labels=self.room_labels)
 
     def build_room_mask_from_square(self, square_in_room):
         room_mask = np.full_like(self.dungeon_feature_map, False, dtype=bool)
@@ -444,7 +571,10 @@ class DLevelMap():
         return self.expand_mask_along_room_floor(room_mask)
 
     def add_room(self, room_mask, room_type):
-        self.special_room_map[room_mask] = room_type.value
+        new_squares = room_mask & (self.special_room_map != room_type.value)
+        if new_squares.any():
+            self.special_room_map[new_squares] = room_type.value
+            self.special_rooms_need_expanding = True
 
     def add_room_from_square(self, square_in_room, room_type):
         room_mask = self.build_room_mask_from_square(square_in_room)
@@ -460,6 +590,8 @@ class DLevelMap():
     def add_feature(self, location, glyph):
         if not isinstance(glyph, gd.CMapGlyph):
             raise Exception("Bad feature glyph")
+        self.feature_counts[self.dungeon_feature_map[location]] -= 1
+        self.feature_counts[glyph.numeral] += 1
         self.dungeon_feature_map[location] = glyph.numeral
         if glyph.is_downstairs or glyph.is_upstairs:
             self.update_stair_counts()
@@ -520,7 +652,7 @@ class DLevelMap():
             if environment.env.debug:
                 import pdb; pdb.set_trace()
             raise Exception("Player locations should match")
-        search_mask = FloodMap.flood_one_level_from_mask(self.player_location_mask)
+        search_mask = morphology.dilate(self.player_location_mask)
         self.searches_count_map[search_mask] += 1
 
     @staticmethod
@@ -553,21 +685,66 @@ class DLevelMap():
         self.special_facts[location] = facts
 
 class FloodMap():
-    @staticmethod
-    def flood_one_level_from_mask(mask):
-        if not mask.dtype == np.dtype('bool'):
-            raise Exception("Bad mask")
+    walking_offsets = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+
+    around_row_offsets = np.array([-1, -1, -1, 0, 0, 0, 1, 1, 1])
+    around_col_offsets = np.array([-1, 0, 1, -1, 0, 1, -1, 0, 1])
 
-        flooded_mask = scipy.signal.convolve2d(mask, np.ones((3,3)), mode='same')
+    @classmethod
+    def squares_around(cls, squares, shape):
+        # Rows and columns of squares (as from np.nonzero) and their neighbors, clipped to the map. May repeat squares
+        rows, cols = squares
+        rows = np.clip(rows[:, np.newaxis] + cls.around_row_offsets, 0, shape[0] - 1).ravel()
+        cols = np.clip(cols[:, np.newaxis] + cls.around_col_offsets, 0, shape[1] - 1).ravel()
+        return rows, cols
+
+    @classmethod
+    def walking_graph(cls, start, walkable, doors, diagonal=True, blocked_moves=(), step_cost=None):
+        # Sparse graph of the legal single steps, weighted by step_cost of the square stepped onto (default 1).
+        # No diagonal moves into or out of doors, and blocked_moves holds (from, to) squares we know don't work
+        rows, cols = walkable.shape
+        index = np.arange(rows * cols).reshape(rows, cols)
+        can_leave = walkable.copy()
+        can_leave[start] = True
+        sources = []
+        destinations = []
+        for dr, dc in cls.walking_offsets:
+            if not diagonal and dr != 0 and dc != 0:
+                continue
+            from_view = (slice(max(-dr, 0), rows + min(-dr, 0)), slice(max(-dc, 0), cols + min(-dc, 0)))
+            to_view = (slice(max(dr, 0), rows + min(dr, 0)), slice(max(dc, 0), cols + min(dc, 0)))
+            legal = can_leave[from_view] & walkable[to_view]
+            if dr != 0 and dc != 0:
+                legal &= ~doors[from_view] & ~doors[to_view]
+            sources.append(index[from_view][legal])
+            destinations.append(index[to_view][legal])
+
+        sources = np.concatenate(sources)
+        destinations = np.concatenate(destinations)
+        if blocked_moves:
+            blocked = [index[f] * index.size + index[t] for f, t in blocked_moves if 0 <= t[0] < rows and 0 <= t[1] < cols and 0 <= f[0] < rows and 0 <= f[1] < cols]
+            allowed = ~np.isin(sources * index.size + destinations, blocked)
+            sources = sources[allowed]
+            destinations = destinations[allowed]
+
+        weights = np.ones(len(sources)) if step_cost is None else step_cost.ravel()[destinations]
+        return scipy.sparse.csr_matrix((weights, (sources, destinations)), shape=(index.size, index.size))
 
-        return (flooded_mask >= 1)
+    @classmethod
+    def walking_distances(cls, start, walkable, doors, diagonal=True):
+        # -1 where there is no way
+        rows, cols = walkable.shape
+        graph = cls.walking_graph(start, walkable, doors, diagonal=diagonal)
+        distances = scipy.sparse.csgraph.shortest_path(graph, method='D', unweighted=True, indices=start[0] * cols + start[1])
+        return np.where(np.isinf(distances), -1, distances).astype(int).reshape(rows, cols)
 
 class ThreatMap(FloodMap):
     INVISIBLE_DAMAGE_THREAT = 6 # gotta do something lol
 
     def __init__(self, character, raw_visible_glyphs, monsters, monster_squares, player_location_in_vision):
         # take the section of the observed glyphs that is relevant
-        self.raw_glyph_grid = raw_visible_glyphs
+        self.frame = gd.GlyphFrame.of(raw_visible_glyphs)
+        self.raw_glyph_grid = self.frame.glyphs
         self.monsters = monsters
         self.monster_squares = monster_squares
         self.player_location_in_glyph_grid = player_location_in_vision
@@ -575,40 +752,38 @@ class ThreatMap(FloodMap):
         self.calculate_threat(character)
         #self.calculate_implied_threat()
 
-    @classmethod
-    def calculate_can_occupy(cls, monster, start, raw_glyph_grid):
-        walkable = gd.walkable(raw_glyph_grid)
+    @staticmethod
+    def free_moves(monster):
         if isinstance(monster, gd.MonsterGlyph):
-            free_moves = np.ceil(monster.monster_spoiler.speed / monster.monster_spoiler.__class__.NORMAL_SPEED) - 1 # -1 because we are interested in move+hit turns not just move turns
-            #print("speed, free_moves:", monster.monster_spoiler.speed, free_moves)
-        elif isinstance(monster, gd.InvisibleGlyph):
-            free_moves = 0
-        
-        mons_square_mask = np.full_like(raw_glyph_grid, False, dtype='bool')
-        mons_square_mask[start] = True
-        can_occupy_mask = mons_square_mask
-
-        if free_moves > 0: # if we can move+attack, we need to know where we can move
-            already_checked_mask = np.full_like(raw_glyph_grid, False, dtype='bool')
-
-        while free_moves > 0:
-            # flood from newly identified squares that we can occupy
-            flooded_mask = cls.flood_one_level_from_mask(can_occupy_mask & ~already_checked_mask)
-            # remember where we've already looked (for efficiency, not correctness)
-            already_checked_mask = can_occupy_mask
-            # add new squares that are also walkable to places we can occupy
-            can_occupy_mask = can_occupy_mask | (flooded_mask & walkable)
-            # use up a move
-            free_moves -= 1
-            #pdb.set_trace()
-
-        return can_occupy_mask  
+            return int(np.ceil(monster.monster_spoiler.speed / monster.monster_spoiler.__class__.NORMAL_SPEED) - 1) # -1 because we are interested in move+hit turns not just move turns
+        return 0
 
     @classmethod
-    def calculate_melee_can_hit(cls, can_occupy_mask):
-        can_hit_mask = cls.flood_one_level_from_mask(can_occupy_mask)
+    def calculate_can_occupy(cls, monsters, starts, raw_glyph_grid):
+        # One mask per monster, stacked. Each step floods every monster that still has free moves at once,
+        # so the cost goes with the largest flood radius rather than the number of monsters
+        frame = gd.GlyphFrame.of(raw_glyph_grid)
+        walkable = frame.layer('walkable')
+        can_occupy_masks = np.full((len(monsters),) + frame.glyphs.shape, False, dtype='bool')
+        for i, start in enumerate(starts):
+            can_occupy_masks[(i,) + tuple(start)] = True
+
+        free_moves = np.array([cls.free_moves(monster) for monster in monsters])
+        for step in range(1, free_moves.max(initial=0) + 1):
+            moving = free_moves >= step
+            can_occupy_masks[moving] |= morphology.dilate(can_occupy_masks[moving]) & walkable
+
+        return can_occupy_masks
 
-        return can_hit_mask
+    @classmethod
+    def calculate_melee_can_hit(cls, can_occupy_masks):
+        return morphology.dilate(can_occupy_masks)
+
+    @staticmethod
+    def accumulate_threat(can_hit_masks, damage, threat_types, n_threat, damage_threat, threat_type):
+        n_threat += can_hit_masks.sum(axis=0, dtype=n_threat.dtype)
+        damage_threat += np.tensordot(damage, can_hit_masks, axes=1)
+        threat_type |= np.bitwise_or.reduce(np.where(can_hit_masks, threat_types[:, np.newaxis, np.newaxis], 0), axis=0)
 
     def calculate_threat(self, character):
         melee_n_threat = np.zeros_like(self.raw_glyph_grid)
@@ -619,6 +794,8 @@ class ThreatMap(FloodMap):
         ranged_damage_threat = np.zeros_like(self.raw_glyph_grid, dtype=float)
         ranged_threat_type = np.zeros_like(self.raw_glyph_grid, dtype=int)
 
+        threatening_monsters = []
+        threatening_squares = []
         for i, monster in enumerate(self.monsters):
             monster_square = physics.Square(self.monster_squares[0][i], self.monster_squares[1][i])
             if isinstance(monster, gd.SwallowGlyph):
@@ -633,37 +810,39 @@ class ThreatMap(FloodMap):
             is_invis = isinstance(monster, gd.InvisibleGlyph)
             if isinstance(monster, gd.MonsterGlyph) or is_invis:
                 if not (isinstance(monster, gd.MonsterGlyph) and monster.single_always_peaceful()): # always peaceful monsters don't need to threaten
-                    ### SHARED ###
-                    can_occupy_mask = self.calculate_can_occupy(monster, monster_square, self.raw_glyph_grid)
-                    ###
-
-                    ### MELEE ###
-                    if is_invis or monster.has_melee:
-                        can_hit_mask = self.calculate_melee_can_hit(can_occupy_mask)
-
-                        melee_n_threat[can_hit_mask] += 1 # monsters threaten their own squares in this implementation OK? TK 
-
-                        if isinstance(monster, gd.MonsterGlyph):
-                            melee_damage, melee_types = monster.monster_spoiler.expected_melee_damage_to_character(character)
-                            melee_damage_threat[can_hit_mask] += melee_damage
-                            melee_threat_type[can_hit_mask] = np.bitwise_or(melee_threat_type[can_hit_mask], melee_types)
-                        elif is_invis:
-                            melee_damage_threat[can_hit_mask] += self.INVISIBLE_DAMAGE_THREAT # how should we imagine the threat of invisible monsters?
-                        else:
-                            assert False, "what kinda monster is this?"
-                    ###
-
-                    ### RANGED ###
-                    if is_invis or monster.has_ranged: # let's let invisible monsters threaten at range so we rush them down someday
-                        can_hit_mask = self.calculate_ranged_can_hit_mask(can_occupy_mask, self.raw_glyph_grid)
-                        ranged_n_threat[can_hit_mask] += 1
-                        if is_invis:
-                            ranged_damage_threat[can_hit_mask] += self.INVISIBLE_DAMAGE_THREAT
-                        else:
-                            ranged_damage, ranged_types = monster.monster_spoiler.expected_ranged_damage_to_character(character)
-                            ranged_damage_threat[can_hit_mask] += ranged_damage
-                            ranged_threat_type[can_hit_mask] = np.bitwise_or(ranged_threat_type[can_hit_mask], ranged_types)
-                    ###
+                    threatening_monsters.append(monster)
+                    threatening_squares.append(monster_square)
+
+        if threatening_monsters:
+            can_occupy_masks = self.calculate_can_occupy(threatening_monsters, threatening_squares, self.frame)
+
+            melee = np.full(len(threatening_monsters), False)
+            ranged = np.full(len(threatening_monsters), False)
+            melee_damage = np.zeros(len(threatening_monsters))
+            ranged_damage = np.zeros(len(threatening_monsters))
+            melee_types = np.zeros(len(threatening_monsters), dtype=int)
+            ranged_types = np.zeros(len(threatening_monsters), dtype=int)
+            for i, monster in enumerate(threatening_monsters):
+                if isinstance(monster, gd.InvisibleGlyph):
+                    # how should we imagine the threat of invisible monsters?
+                    # let's let them threaten at range too so we rush them down someday
+                    melee[i] = ranged[i] = True
+                    melee_damage[i] = ranged_damage[i] = self.INVISIBLE_DAMAGE_THREAT
+                    continue
+
+                if monster.has_melee:
+                    melee[i] = True
+                    melee_damage[i], melee_types[i] = monster.monster_spoiler.expected_melee_damage_to_character(character)
+                if monster.has_ranged:
+                    ranged[i] = True
+                    ranged_damage[i], ranged_types[i] = monster.monster_spoiler.expected_ranged_damage_to_character(character)
+
+            if melee.any():
+                can_hit_masks = self.calculate_melee_can_hit(can_occupy_masks[melee])
+                self.accumulate_threat(can_hit_masks, melee_damage[melee], melee_types[melee], melee_n_threat, melee_damage_threat, melee_threat_type)
+            if ranged.any():
+                can_hit_masks = self.calculate_ranged_can_hit_masks(can_occupy_masks[ranged], self.frame)
+                self.accumulate_threat(can_hit_masks, ranged_damage[ranged], ranged_types[ranged], ranged_n_threat, ranged_damage_threat, ranged_threat_type)
 
         self.melee_n_threat = melee_n_threat
         self.melee_damage_threat = melee_damage_threat
@@ -676,55 +855,65 @@ class ThreatMap(FloodMap):
         #if self.ranged_threat_type.any():
         #    import pdb; pdb.set_trace()
 
-    @classmethod
-    def calculate_ranged_can_hit_mask(cls, can_occupy_mask, glyph_grid, attack_range=None, **kwargs):
-        # TODO make gaze attacks hit everywhere
-        it = np.nditer(can_occupy_mask, flags=['multi_index'])
-        masks = []
-        for b in it: 
-            if b:
-                can_hit_from_loc = cls.raytrace_from(physics.Square(*it.multi_index), glyph_grid, **kwargs)
-                masks.append(can_hit_from_loc)
-        return np.logical_or.reduce(masks)
-
     @staticmethod
-    def raytrace_from(source, glyph_grid, include_adjacent=False, stop_on_monsters=False, reject_peaceful=False, stop_on_boulders=True):
-        row_lim = glyph_grid.shape[0]
-        col_lim = glyph_grid.shape[1]
+    @functools.lru_cache(maxsize=None)
+    def ray_table(shape):
+        # For every square and each of the 8 directions, the flat indices of the squares a ray passes through in order,
+        # starting one step out. Rays that leave the grid early are padded with rows * cols, one past the last square
+        rows, cols = shape
+        length = max(rows, cols) - 1
+        table = np.full((rows * cols, len(physics.action_deltas), length), rows * cols, dtype=int)
+        for row in range(rows):
+            for col in range(cols):
+                for direction, (dr, dc) in enumerate(physics.action_deltas):
+                    for step in range(length):
+                        r, c = row + dr * (step + 1), col + dc * (step + 1)
+                        if not (0 <= r < rows and 0 <= c < cols):
+                            break
+                        table[row * cols + col, direction, step] = r * cols + c
+        return table
 
-        blocking_geometry = gd.CMapGlyph.wall_mask(glyph_grid) | gd.CMapGlyph.closed_door_mask(glyph_grid)
+    @staticmethod
+    def blocking_geometry(glyph_grid, stop_on_monsters=False, reject_peaceful=False, stop_on_boulders=True):
+        frame = gd.GlyphFrame.of(glyph_grid)
+        blocking_geometry = frame.layer('wall') | frame.layer('closed_door')
         if stop_on_boulders:
-            blocking_geometry |= gd.RockGlyph.boulder_mask(glyph_grid)
+            blocking_geometry |= frame.layer('boulder')
         if reject_peaceful:
-            blocking_geometry |= (gd.PetGlyph.class_mask(glyph_grid) | gd.MonsterGlyph.always_peaceful_mask(glyph_grid))
+            blocking_geometry |= (frame.layer('pet') | frame.layer('always_peaceful'))
         if stop_on_monsters:
-            blocking_geometry |= gd.MonsterGlyph.class_mask(glyph_grid)
+            blocking_geometry |= frame.layer('monster')
+        return blocking_geometry
 
-        ray_offsets = physics.action_deltas
-
-        masks = []
-        for offset in ray_offsets:
-            ray_mask = np.full_like(glyph_grid, False, dtype='bool')
-
-            current = source
-            current = current + physics.Square(*offset) # initial bump so that ranged attacks don't threaten adjacent squares
-            while 0 <= current[0] < row_lim and 0 <= current[1] < col_lim:
-                blocked = blocking_geometry[current]
-                ray_mask[current] = True # moved before blocking since technically you can hit things in walls with ranged attacks
-                if blocked: # is this the full extent of what blocks projectiles/rays?
-                    break # should we do anything with bouncing rays
-
-
-                current = (current[0]+offset[0], current[1]+offset[1])
+    @classmethod
+    def calculate_ranged_can_hit_masks(cls, can_occupy_masks, glyph_grid, attack_range=None, include_adjacent=False, **kwargs):
+        # TODO make gaze attacks hit everywhere
+        # Every ray from every square each monster can occupy at once. A ray reaches a square if nothing before it along the ray blocks,
+        # and includes the first blocker since technically you can hit things in walls with ranged attacks
+        frame = gd.GlyphFrame.of(glyph_grid)
+        monster_index, sources = np.nonzero(can_occupy_masks.reshape(len(can_occupy_masks), -1))
+        rays = cls.ray_table(frame.glyphs.shape)[sources]
+        blocking = np.append(cls.blocking_geometry(frame, **kwargs).ravel(), True)
+        blocked = blocking[rays]
+        reached = (np.cumsum(blocked, axis=-1) - blocked) == 0
+        if not include_adjacent:
+            # the first step of each ray is exactly the squares adjacent to its source
+            reached[..., 0] = False
 
-            masks.append(ray_mask)
+        can_hit_masks = np.full((len(can_occupy_masks), frame.glyphs.size + 1), False, dtype='bool')
+        can_hit_masks[np.broadcast_to(monster_index[:, np.newaxis, np.newaxis], rays.shape)[reached], rays[reached]] = True
+        return can_hit_masks[:, :-1].reshape(can_occupy_masks.shape)
 
-        can_hit_mask = np.logical_or.reduce(masks)
+    @classmethod
+    def calculate_ranged_can_hit_mask(cls, can_occupy_mask, glyph_grid, **kwargs):
+        return cls.calculate_ranged_can_hit_masks(can_occupy_mask[np.newaxis], glyph_grid, **kwargs)[0]
 
-        if not include_adjacent:
-            adjacent_rows, adjacent_cols = utilities.centered_slices_bounded_on_array(source, (1,1), can_hit_mask)
-            can_hit_mask[adjacent_rows, adjacent_cols] = False
-        return can_hit_mask
+    @classmethod
+    def raytrace_from(cls, source, glyph_grid, include_adjacent=False, **kwargs):
+        # The squares a ranged attack from the single square source can hit, e.g. our own line of fire
+        source_mask = np.full(gd.GlyphFrame.of(glyph_grid).glyphs.shape, False, dtype='bool')
+        source_mask[source] = True
+        return cls.calculate_ranged_can_hit_mask(source_mask, glyph_grid, include_adjacent=include_adjacent, **kwargs)
 
 class SpecialLevelDecoder():
     CHARACTER_SET = None
@@ -861,7 +1050,7 @@ class SpecialLevelMap():
         self.cmap_glyphs = self.cmap_glyph_decoder.decode(nethack_wiki_encoding)
         self.potential_walls = self.potential_wall_decoder.decode(nethack_wiki_encoding)
         self.potential_secret_doors = self.potential_secret_door_decoder.decode(nethack_wiki_encoding)
-        self.adjacent_to_secret = FloodMap.flood_one_level_from_mask(self.potential_secret_doors)
+        self.adjacent_to_secret = morphology.dilate(self.potential_secret_doors)
         self.traps_to_avoid = self.traps_to_avoid_decoder.decode(nethack_wiki_encoding)
         self.unobserved = self.unobserved_decoder.decode(nethack_wiki_encoding)
 
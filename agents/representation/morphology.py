@@ -0,0 +1,62 @@
+import numpy as np
+import scipy.ndimage
+
+# Operations on boolean masks over the map (or stacks of them, along leading axes).
+# Squares past the edge of the map count as False
+
+EIGHT_CONNECTED = np.ones((3, 3), dtype=bool)
+
+def check_mask(mask):
+    if not mask.dtype == np.dtype('bool'):
+        raise Exception("Bad mask")
+
+# The 3x3 box is separable: combine each square with its left and right neighbors, then the result with up and down
+
+def dilate(mask):
+    # Every square that is in mask or next to a square in mask
+    check_mask(mask)
+    dilated = mask.copy()
+    dilated[..., 1:] |= mask[..., :-1]
+    dilated[..., :-1] |= mask[..., 1:]
+    rows = dilated.copy()
+    dilated[..., 1:, :] |= rows[..., :-1, :]
+    dilated[..., :-1, :] |= rows[..., 1:, :]
+    return dilated
+
+def dilate_n(mask, n, within=None):
+    # n steps of dilate, staying on the squares of within if given
+    for _ in range(n):
+        dilated = dilate(mask)
+        if within is not None:
+            dilated &= within
+        if (dilated == mask).all():
+            break
+        mask = dilated
+    return mask
+
+def label_components(mask):
+    # 8-connected components of mask, numbered from 1, with 0 off the mask. Returns (labels, count)
+    check_mask(mask)
+    return scipy.ndimage.label(mask, structure=EIGHT_CONNECTED)
+
+def flood_fill(seeds, within, labels=None):
+    # Fixed point of repeatedly dilating seeds and keeping only squares of within: the components of
+    # within that touch seeds. Pass labels from label_components(within) to reuse them
+    check_mask(seeds)
+    if labels is None:
+        labels, _ = label_components(within)
+    touched = np.full(labels.max() + 1, False)
+    touched[labels[dilate(seeds)]] = True
+    touched[0] = False
+    return touched[labels]
+
+def neighbor_counts(mask):
+    # For each square, how many squares of mask are in the 3x3 box around it (including itself)
+    check_mask(mask)
+    counts = mask.astype(np.intp)
+    counts[..., 1:] += mask[..., :-1]
+    counts[..., :-1] += mask[..., 1:]
+    rows = counts.copy()
+    counts[..., 1:, :] += rows[..., :-1, :]
+    counts[..., :-1, :] += rows[..., 1:, :]
+    return counts
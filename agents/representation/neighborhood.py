@@ -4,16 +4,16 @@ from typing import NamedTuple
 
 import enum
 
-from astar import AStar
-import math
+import contextlib
 from nle import nethack
 import numpy as np
-import scipy.signal
+import scipy.sparse.csgraph
 
 import agents.representation.constants as constants
 import environment
 import agents.representation.glyphs as gd
 import agents.representation.map as map
+import agents.representation.morphology as morphology
 import agents.representation.physics as physics
 import utilities
 from utilities import ARS
@@ -109,6 +109,7 @@ class Neighborhood(): # goal: mediates all access to glyphs by advisors
         self.character = character
         absolute_player_location = Square(*current_square.location)
         self.failed_move_record = failed_move_record
+        self.threat_weighted_paths = False
 
         self.previous_glyph_on_player = current_square.glyph_under_player
         self.item_on_player = current_square.item_on_square
@@ -123,12 +124,14 @@ class Neighborhood(): # goal: mediates all access to glyphs by advisors
         #############################
         ### FULL EXTENT OF VISION ###
         #############################
+        frame = gd.GlyphFrame.of(glyphs)
         self.vision = utilities.centered_slices_bounded_on_array(
-            absolute_player_location, (self.extended_vision, self.extended_vision), glyphs
+            absolute_player_location, (self.extended_vision, self.extended_vision), frame.glyphs
         )
         vision_start = Square(self.vision[0].start, self.vision[1].start)
 
-        extended_visible_raw_glyphs = glyphs[self.vision]
+        self.vision_frame = frame.view(self.vision)
+        extended_visible_raw_glyphs = self.vision_frame.glyphs
         self.vision_glyphs = extended_visible_raw_glyphs
         # index of player in the full vision
         player_location_in_extended = absolute_player_location - vision_start
@@ -139,7 +142,7 @@ class Neighborhood(): # goal: mediates all access to glyphs by advisors
         ####################
         if not am_hallu:
             # don't create shops while we're hallucinating
-            is_shopkeeper = gd.MonsterGlyph.shopkeeper_mask(extended_visible_raw_glyphs)
+            is_shopkeeper = self.vision_frame.layer('shopkeeper')
             shopkeeper_present = is_shopkeeper.any()
 
             if shopkeeper_present:
@@ -157,7 +160,7 @@ class Neighborhood(): # goal: mediates all access to glyphs by advisors
         ###################################
 
         extended_visits = level_map.visits_count_map[self.vision]
-        extended_open_door = gd.CMapGlyph.open_door_mask(extended_visible_raw_glyphs)
+        extended_open_door = self.vision_frame.layer('open_door')
         self.extended_embeds = self.zoom_glyph_alike(
             level_map.embedded_object_map,
             ViewField.Extended
@@ -178,7 +181,7 @@ class Neighborhood(): # goal: mediates all access to glyphs by advisors
         self.obvious_mimics = self.zoom_glyph_alike(self.level_map.obvious_mimics, ViewField.Extended)
         extended_nasty_traps = self.zoom_glyph_alike(self.level_map.traps_to_avoid, ViewField.Extended)
 
-        extended_is_monster = gd.monster_like_mask(extended_visible_raw_glyphs)
+        extended_is_monster = self.vision_frame.layer('monster_like').copy()
         extended_is_monster[player_location_in_extended] = False # player does not count as a monster anymore
         if self.level_map.dcoord.branch == map.Branches.Sokoban:
             extended_is_monster[self.obvious_mimics] = True
@@ -195,18 +198,15 @@ class Neighborhood(): # goal: mediates all access to glyphs by advisors
 
         self.extended_is_monster = extended_is_monster
         #import pdb; pdb.set_trace()
-        monsters = np.where(extended_is_monster, extended_visible_raw_glyphs, False)
-        unmeleeable_monsters = np.full_like(monsters, False, dtype=bool)
-        unmeleeable_monsters[self.extended_is_monster] = utilities.vectorized_map(
-            lambda g: isinstance(gd.GLYPH_NUMERAL_LOOKUP[g], gd.MonsterGlyph) and not gd.GLYPH_NUMERAL_LOOKUP[g].monster_spoiler.char_would_tussle_with(character),
-            monsters[self.extended_is_monster]
-        )
+        unmeleeable_monsters = np.full_like(extended_is_monster, False)
+        if extended_is_monster.any():
+            unmeleeable_monsters = character.unmeleeable_glyphs()[extended_visible_raw_glyphs] & extended_is_monster
         #if extended_is_dangerous_monster.any():
         #    import pdb; pdb.set_trace()
         self.unmeleeable_monsters = unmeleeable_monsters
-        self.extended_is_peaceful_monster = gd.MonsterGlyph.always_peaceful_mask(extended_visible_raw_glyphs)
+        self.extended_is_peaceful_monster = self.vision_frame.layer('always_peaceful')
         self.extended_possible_secret_mask = self.zoom_glyph_alike(self.level_map.possible_secrets, ViewField.Extended)
-        self.extended_has_item_stack = gd.stackable_mask(extended_visible_raw_glyphs)
+        self.extended_has_item_stack = self.vision_frame.layer('stackable')
 
         self.extended_is_hostile_monster = self.extended_is_monster & ~self.extended_is_peaceful_monster
 
@@ -282,7 +282,8 @@ class Neighborhood(): # goal: mediates all access to glyphs by advisors
         ### MAPS DERVIED FROM EXTENDED VISION ###
         #########################################
         self.make_monsters(character)
-        self.threat_map = map.ThreatMap(character, extended_visible_raw_glyphs, self.monsters, self.monsters_idx, player_location_in_extended)
+        with utilities.timed_stage('threat_map'):
+            self.threat_map = map.ThreatMap(character, self.vision_frame, self.monsters, self.monsters_idx, player_location_in_extended)
         self.extended_threat = self.threat_map.melee_damage_threat + self.threat_map.ranged_damage_threat
         self.extended_threat_types = self.threat_map.melee_threat_type | self.threat_map.ranged_threat_type
         #########################################
@@ -300,7 +301,7 @@ class Neighborhood(): # goal: mediates all access to glyphs by advisors
 
     def count_adjacent_searches(self, search_threshold):
         below_threshold_mask = self.level_map.searches_count_map[self.vision] < search_threshold
-        adjacencies = scipy.signal.convolve2d(self.extended_possible_secret_mask & below_threshold_mask, np.ones((3,3)), mode='same')
+        adjacencies = morphology.neighbor_counts(self.extended_possible_secret_mask & below_threshold_mask)
         return adjacencies[self.neighborhood_view]
 
     class Path(NamedTuple):
@@ -308,6 +309,15 @@ class Neighborhood(): # goal: mediates all access to glyphs by advisors
         delta: tuple
         threat: float
 
+    @contextlib.contextmanager
+    def avoiding_threat(self):
+        # Within this, path_to_targets prefers the least threatening route over the shortest
+        self.threat_weighted_paths = True
+        try:
+            yield
+        finally:
+            self.threat_weighted_paths = False
+
     def path_to_targets(self, target_mask, target_monsters=False, be_prudent=True):
         if be_prudent:
             target_mask = target_mask & ~self.imprudent
@@ -320,7 +330,7 @@ class Neighborhood(): # goal: mediates all access to glyphs by advisors
 
         if target_monsters:
             # we only need to be adjacent to monsters to attack them
-            target_mask = map.FloodMap.flood_one_level_from_mask(target_mask)
+            target_mask = morphology.dilate(target_mask)
 
         pathfinder = Pathfinder(
             walkable_mesh=walkable_mesh,
@@ -330,24 +340,10 @@ class Neighborhood(): # goal: mediates all access to glyphs by advisors
             failed_moves = self.failed_move_record,
             diagonal=self.level_map.dcoord.branch != map.Branches.Sokoban,
         )
-        it = np.nditer(target_mask, flags=['multi_index'])
-
-        shortest_path = None
-        shortest_length = None
-
-        for is_target in it:
-            if is_target:
-                # start, goal
-                path_iterator = pathfinder.astar(self.player_location_in_extended, Square(*it.multi_index))
-                if path_iterator is None:
-                    path = None
-                    path_length = None
-                else:
-                    path = list(path_iterator)
-                    path_length = len(path)
-                if shortest_path is None or (shortest_length and path_length and shortest_length > path_length):
-                    shortest_path = path
-                    shortest_length = path_length
+        if self.threat_weighted_paths:
+            shortest_path = pathfinder.least_threatening_path(target_mask, self.extended_threat)
+        else:
+            shortest_path = pathfinder.path_to_nearest(target_mask)
 
         if shortest_path is None or len(shortest_path) == 1: # couldn't pathfind to any / already on target
             return None
@@ -375,7 +371,7 @@ class Neighborhood(): # goal: mediates all access to glyphs by advisors
         return self.path_to_targets(meleeable_monsters, target_monsters=True)
 
     def path_to_tactical_square(self):
-        tactical_squares = gd.CMapGlyph.tactical_square_mask(self.vision_glyphs)
+        tactical_squares = self.vision_frame.layer('tactical_square')
         return self.path_to_targets(tactical_squares)
 
     def desirable_object_on_space(self, character):
@@ -395,7 +391,7 @@ class Neighborhood(): # goal: mediates all access to glyphs by advisors
         return desirable_object_on_space
 
     def path_invisible_monster(self):
-        invisible_monsters = gd.InvisibleGlyph.class_mask(self.vision_glyphs)
+        invisible_monsters = self.vision_frame.layer('invisible')
         return self.path_to_targets(invisible_monsters, target_monsters=True)
     
     def path_obvious_mimics(self):
@@ -541,9 +537,7 @@ class Neighborhood(): # goal: mediates all access to glyphs by advisors
             satisfying_monsters = []
             satisfying_directions = []
             absolute_positions = []
-            player_mask = np.full_like(self.vision_glyphs, False, dtype=bool)
-            player_mask[self.player_location_in_extended] = True
-            can_hit_mask = self.threat_map.calculate_ranged_can_hit_mask(player_mask, self.vision_glyphs, attack_range=attack_range, include_adjacent=include_adjacent, stop_on_monsters=True, reject_peaceful=True, stop_on_boulders=False)
+            can_hit_mask = self.threat_map.raytrace_from(self.player_location_in_extended, self.vision_frame, attack_range=attack_range, include_adjacent=include_adjacent, stop_on_monsters=True, reject_peaceful=True, stop_on_boulders=False)
             for i, monster in enumerate(self.monsters):
                 monster_square = physics.Square(self.monsters_idx[0][i], self.monsters_idx[1][i])
                 if can_hit_mask[monster_square] and monster_selector(monster) and (allow_anger or self.safe_detonation(monster, monster_square, source_type='extended')):
@@ -557,7 +551,8 @@ class Neighborhood(): # goal: mediates all access to glyphs by advisors
             #import pdb; pdb.set_trace()
             return Targets(satisfying_monsters, satisfying_directions, absolute_positions)
 
-class Pathfinder(AStar):
+class Pathfinder():
+    # Breadth first search out from the player, so one pass finds the nearest of any number of targets
     def __init__(self, walkable_mesh, doors, player_location, absolute_player_location, failed_moves, diagonal=True):
         self.walkable_mesh = walkable_mesh
         self.doors = doors
@@ -566,36 +561,74 @@ class Pathfinder(AStar):
         self.absolute_player_location = absolute_player_location
         self.failed_moves = failed_moves
 
-    def neighbors(self, node):
-        box_slices = utilities.centered_slices_bounded_on_array(node, (1,1), self.walkable_mesh) # radius 1 square
-        upper_left = Square(box_slices[0].start, box_slices[1].start)
-        current_square = node - upper_left
-        walkable_box = self.walkable_mesh[box_slices]
-        door_box = self.doors[box_slices]
-
-        neighboring_walkable_squares = []
-        it = np.nditer(walkable_box, flags=['multi_index'])
-        for walkable in it:
-            square = Square(*it.multi_index)
-            #import pdb; pdb.set_trace()
-            is_orthogonal = np.sum(np.abs(square-current_square)) == 1
-            if walkable and (self.diagonal or is_orthogonal) and (not door_box[current_square] or is_orthogonal) and (not door_box[square] or is_orthogonal):
-                neighboring_walkable_squares.append(square + upper_left)
-
-        failed_moves_at_node = self.failed_moves.failed_moves[node - self.player_location + self.absolute_player_location]
-        #if len(failed_moves_at_node) > 0 and environment.env.debug: import pdb; pdb.set_trace()
-        for f in failed_moves_at_node:
-            #import pdb; pdb.set_trace()
-            failed_target = physics.offset_location_by_action(node, f.move)
-            try:
-                neighboring_walkable_squares.remove(failed_target)
-            except ValueError:
-                pass
-
-        return neighboring_walkable_squares
+    def blocked_moves(self):
+        blocked = set()
+        for location, failed_moves_at_location in self.failed_moves.failed_moves.items():
+            node = Square(*location) - self.absolute_player_location + self.player_location
+            for f in failed_moves_at_location:
+                blocked.add((node, physics.offset_location_by_action(node, f.move)))
+        return blocked
+
+    def path_to_nearest(self, target_mask):
+        # Returns the squares from the player to the nearest target, inclusive. Ties go to the first target in row-major order
+        rows, cols = self.walkable_mesh.shape
+        walkable = self.walkable_mesh.tolist()
+        doors = self.doors.tolist()
+        targets = target_mask.tolist()
+        blocked = self.blocked_moves()
+
+        start = Square(*self.player_location)
+        came_from = {start: None}
+        layer = [start]
+        reached = [start] if targets[start[0]][start[1]] else []
+
+        while layer and not reached:
+            next_layer = []
+            for node in layer:
+                row, col = node
+                node_is_door = doors[row][col]
+                for r in range(max(row - 1, 0), min(row + 2, rows)):
+                    for c in range(max(col - 1, 0), min(col + 2, cols)):
+                        if not walkable[r][c]:
+                            continue
+                        is_orthogonal = (r == row) != (c == col)
+                        if not is_orthogonal and (not self.diagonal or node_is_door or doors[r][c]):
+                            continue
+                        square = Square(r, c)
+                        if square in came_from or (node, square) in blocked:
+                            continue
+                        came_from[square] = node
+                        next_layer.append(square)
+                        if targets[r][c]:
+                            reached.append(square)
+            layer = next_layer
+
+        if not reached:
+            return None
 
-    def distance_between(self, n1, n2):
-        return 1 # diagonal moves are strong!
+        path = [min(reached)]
+        while came_from[path[-1]] is not None:
+            path.append(came_from[path[-1]])
+        path.reverse()
+        return path
+
+    def least_threatening_path(self, target_mask, threat):
+        # Dijkstra where each step costs 1 plus the threat on the square stepped onto,
+        # so a point of expected damage is worth one extra step of walking around it
+        rows, cols = self.walkable_mesh.shape
+        graph = map.FloodMap.walking_graph(
+            self.player_location, self.walkable_mesh, self.doors, diagonal=self.diagonal,
+            blocked_moves=self.blocked_moves(), step_cost=1. + threat,
+        )
+        start = self.player_location[0] * cols + self.player_location[1]
+        costs, predecessors = scipy.sparse.csgraph.dijkstra(graph, indices=start, return_predecessors=True)
+        costs = np.where(target_mask.ravel(), costs, np.inf)
+        nearest = np.argmin(costs)
+        if np.isinf(costs[nearest]):
+            return None
 
-    def heuristic_cost_estimate(self, current, goal):
-        return math.hypot(*(current - goal))
+        path = [nearest]
+        while path[-1] != start:
+            path.append(predecessors[path[-1]])
+        path.reverse()
+        return [Square(*divmod(int(i), cols)) for i in path]
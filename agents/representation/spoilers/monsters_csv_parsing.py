@@ -79,18 +79,33 @@ class MonsterSpoiler():
         return False
 
     def expected_melee_damage_to_character(self, character):
+        return damage_table(character)[self.name].melee
+
+    def calculate_melee_damage_to_character(self, character):
         return self.melee_attack_bundle.expected_damage_to_character(character, self.max_level, self.speed)
 
     def expected_ranged_damage_to_character(self, character):
+        return damage_table(character)[self.name].ranged
+
+    def calculate_ranged_damage_to_character(self, character):
         return self.ranged_attack_bundle.expected_damage_to_character(character, self.max_level, self.speed)
 
     def expected_engulf_damage_to_character(self, character):
+        return damage_table(character)[self.name].engulf
+
+    def calculate_engulf_damage_to_character(self, character):
         return self.engulf_attack_bundle.expected_damage_to_character(character, self.max_level, self.speed)
 
     def expected_passive_damage_to_character(self, character):
+        return damage_table(character)[self.name].passive
+
+    def calculate_passive_damage_to_character(self, character):
         return self.passive_attack_bundle.expected_damage_to_character(character, self.max_level)
 
     def expected_death_damage_to_character(self, character):
+        return damage_table(character)[self.name].death
+
+    def calculate_death_damage_to_character(self, character):
         return self.death_attack_bundle.expected_damage_to_character(character, self.max_level)
 
     def actions_per_unit_time(self):
@@ -329,6 +344,40 @@ for _, row in monster_df.iterrows():
     #dps_row = [spoiler.melee_dps(AC) for AC in ACs]
     #dps_rows[name] = dps_row
 
+class MonsterDamage(NamedTuple):
+    melee: threat.Threat
+    ranged: threat.Threat
+    engulf: threat.Threat
+    passive: threat.Threat
+    death: threat.Threat
+
+DAMAGE_TABLES = {}
+MAX_DAMAGE_TABLES = 64
+
+def damage_table(character):
+    return character.memoized('damage_table', lambda: lookup_damage_table(character))
+
+def lookup_damage_table(character):
+    # Expected damage only depends on the character's AC and intrinsics (resistances, reflection, speed),
+    # so one table per combination serves every step and every episode that sees it again
+    key = (character.AC, character.intrinsics())
+    table = DAMAGE_TABLES.get(key, None)
+    if table is None:
+        if len(DAMAGE_TABLES) >= MAX_DAMAGE_TABLES:
+            DAMAGE_TABLES.clear()
+        table = {
+            name: MonsterDamage(
+                spoiler.calculate_melee_damage_to_character(character),
+                spoiler.calculate_ranged_damage_to_character(character),
+                spoiler.calculate_engulf_damage_to_character(character),
+                spoiler.calculate_passive_damage_to_character(character),
+                spoiler.calculate_death_damage_to_character(character),
+            )
+            for name, spoiler in MONSTERS_BY_NAME.items()
+        }
+        DAMAGE_TABLES[key] = table
+    return table
+
 #dps_df = pd.DataFrame.from_dict(dps_rows, orient='index', columns=ACs)
 #with open(os.path.join(os.path.dirname(__file__), "dps.csv"), 'w') as f:
 #	dps_df.to_csv(f)
@@ -2,6 +2,8 @@ import enum
 from agents.representation.constants import Intrinsics
 from typing import NamedTuple
 
+import numpy as np
+
 class CharacterThreat(enum.IntEnum):
     safe = 0
     low = 1
@@ -107,6 +109,13 @@ def evaluate_threat_damage(threat, character):
 
     return CharacterThreat.safe
 
+def evaluate_threat_damages(damages, character):
+    # evaluate_threat_damage over an array of damages
+    levels = np.where(damages > 0, CharacterThreat.low.value, CharacterThreat.safe.value)
+    levels[damages >= character.current_hp * 0.15] = CharacterThreat.high.value
+    levels[damages >= character.current_hp * 0.5] = CharacterThreat.deadly.value
+    return levels
+
 def evaluate_threat(threat, character):
     return (evaluate_threat_damage(threat,character), evaluate_threat_type(threat,character))
 
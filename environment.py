@@ -15,6 +15,11 @@ class EnvironmentVariable(NamedTuple):
     wizard: bool
     use_seed_whitelist: bool
     max_score: int
+    results_store: str
+    pipeline_envs: bool
+    time_steps: bool
+    profile_stages: bool
+    verify_map_updates: bool
 
     def dump(self):
         self_dict = self._asdict()
@@ -50,6 +55,11 @@ def make_environment(**kwargs):
         'wizard': False,
         'use_seed_whitelist': False,
         'max_score': 3600,
+        'results_store': None,
+        'pipeline_envs': False,
+        'time_steps': False,
+        'profile_stages': False,
+        'verify_map_updates': False,
     }
 
     environment = {
@@ -65,6 +75,11 @@ def make_environment(**kwargs):
         'wizard':(os.getenv("NLE_DEV_WIZARD") == "true"),
         'use_seed_whitelist':(os.getenv("NLE_USE_SEED_WHITELIST") == "true"),
         'max_score':try_cast(int, os.getenv("NLE_DEV_MAX_SCORE")),
+        'results_store':os.getenv("NLE_DEV_RESULTS_STORE"),
+        'pipeline_envs':(os.getenv("NLE_DEV_PIPELINE_ENVS") == "true"),
+        'time_steps':(os.getenv("NLE_DEV_TIME_STEPS") == "true"),
+        'profile_stages':(os.getenv("NLE_DEV_PROFILE_STAGES") == "true"),
+        'verify_map_updates':(os.getenv("NLE_DEV_VERIFY_MAP_UPDATES") == "true"),
     }
     default_environment.update({k:v for k,v in environment.items() if v is not None})
     default_environment.update(kwargs)
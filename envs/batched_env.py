@@ -1,4 +1,12 @@
+import concurrent.futures
+from typing import Any, NamedTuple
+import time
+
 import environment
+import utilities
+
+# Placed on a shared seed queue once per environment to tell it the work is done
+NO_MORE_SEEDS = 'no_more_seeds'
 
 def log_new_run(env):
     if not (environment.env.print_seed or environment.env.debug): return
@@ -7,11 +15,17 @@ def log_new_run(env):
     print(f"[{env._episode} {reseed} {core_seed} {disp_seed}] Starting run.")
 
 class InstrumentedEnv:
-    def __init__(self, env_make_fn, seeds=[]):
+    def __init__(self, env_make_fn, seeds=[], seed_queue=None):
         """
         Creates multiple copies of the environment with the same env_make_fn function
+
+        If seed_queue is given, seeds are pulled from it (None meaning an unseeded episode)
+        until NO_MORE_SEEDS comes off the queue, at which point out_of_seeds is set.
         """
         self.seeds = seeds
+        self.seed_queue = seed_queue
+        self.out_of_seeds = False
+        self.latency = None
         self.env_make_fn = env_make_fn
         env, observation = self.make_environment()
         self.env = env
@@ -20,6 +34,12 @@ class InstrumentedEnv:
         self.num_actions = self.env.action_space.n
 
     def next_seed(self):
+        if self.seed_queue is not None:
+            seed = self.seed_queue.get()
+            if seed == NO_MORE_SEEDS:
+                self.out_of_seeds = True
+                return None
+            return seed
         if not self.seeds:
             return None
         return self.seeds.pop(0)
@@ -33,19 +53,29 @@ class InstrumentedEnv:
     def seeded():
         return environment.env.use_seed_whitelist or environment.env.debug or environment.env.print_seed
 
+    def timed(self, kind, f, *args):
+        if self.latency is None:
+            return f(*args)
+        start = time.perf_counter()
+        retval = f(*args)
+        self.latency[kind].record(time.perf_counter() - start)
+        return retval
+
     def reset_environment(self, env):
+        # Each reset starts a new episode, and with it fresh step latency histograms
+        self.latency = utilities.new_step_latency() if environment.env.time_steps else None
         next_seed = self.next_seed()
         if next_seed:
             print("Adding seed")
             print(next_seed)
             env.unwrapped.seed(next_seed[0], next_seed[1], False)
         else:
-            if environment.env.use_seed_whitelist:
+            if environment.env.use_seed_whitelist and not self.out_of_seeds:
                 print("Ran out of seeds!")
             if self.seeded():
                 env.unwrapped.seed(None, None, False)
 
-        observation = env.reset()
+        observation = self.timed('reset', env.reset)
         log_new_run(env)
         return observation
 
@@ -56,13 +86,16 @@ class InstrumentedEnv:
         info = {}
 
         total_score = 0
+        steps = 0
         crashed = False
+        latency = self.latency
 
         try:
             while True:
-                action = agent.step(observation, reward, done, info)
-                observation, reward, done, info = self.env.step(action)
+                action = self.timed('agent', agent.step, observation, reward, done, info)
+                observation, reward, done, info = self.timed('env', self.env.step, action)
                 total_score += reward
+                steps += 1
                 if done:
                     break
         except Exception as e:
@@ -70,10 +103,126 @@ class InstrumentedEnv:
             if environment.env.debug: raise(e)
             crashed = True
         else:
-            agent.run_state.log_final_state(reward, info["is_ascended"])
+            agent.run_state.log_final_state(reward, info["is_ascended"], latency)
         finally:
             self.initial_observation = self.reset_environment(self.env)
             agent.run_state.reset()
 
 
-        return info.get("is_ascended", False), crashed, total_score
+        return info.get("is_ascended", False), crashed, total_score, steps, latency
+
+
+class FinishedEpisode(NamedTuple):
+    env_index: int
+    seed: Any
+    ascended: bool
+    crashed: bool
+    score: int
+    steps: int
+    wall_time: float
+    latency: Any = None
+
+class BatchedInstrumentedEnv:
+    def __init__(self, env_make_fn, num_envs, seed_queue=None, pipelined=False):
+        """
+        Runs several InstrumentedEnvs in one process, all drawing seeds from the same seed_queue
+
+        If pipelined, each env.step runs on a worker thread and is only collected on that env's next turn,
+        so NLE can be stepping some envs while the agent works out actions for the others.
+        """
+        self.envs = [InstrumentedEnv(env_make_fn=env_make_fn, seed_queue=seed_queue) for _ in range(num_envs)]
+        self.num_actions = self.envs[0].num_actions
+        self.pipelined = pipelined
+        self.executor = None
+
+    def episode_seed(self, env_index, agent):
+        if not InstrumentedEnv.seeded():
+            return None
+        core, disp, _ = self.envs[env_index].env.get_seeds()
+        return (core, disp, agent.agents[env_index].run_state.seed)
+
+    def submit_step(self, env, action):
+        if self.executor is not None:
+            return self.executor.submit(env.timed, 'env', env.env.step, action)
+
+        step = concurrent.futures.Future()
+        try:
+            step.set_result(env.timed('env', env.env.step, action))
+        except Exception as e:
+            step.set_exception(e)
+        return step
+
+    def run_episodes(self, agent):
+        """
+        Round-robins a BatchedCustomAgent over the envs, yielding a FinishedEpisode as each episode ends
+        """
+        num_envs = len(self.envs)
+        observations = [env.initial_observation for env in self.envs]
+        rewards = [0] * num_envs
+        infos = [{} for _ in range(num_envs)]
+        scores = [0] * num_envs
+        steps = [0] * num_envs
+        seeds = [self.episode_seed(i, agent) for i in range(num_envs)]
+        start_times = [time.time()] * num_envs
+        pending_steps = [None] * num_envs
+
+        if self.pipelined:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_envs)
+
+        try:
+            live = [i for i, env in enumerate(self.envs) if not env.out_of_seeds]
+            while live:
+                for i in list(live):
+                    env = self.envs[i]
+                    done = False
+                    crashed = False
+                    try:
+                        if pending_steps[i] is not None:
+                            step = pending_steps[i]
+                            pending_steps[i] = None
+                            observations[i], rewards[i], done, infos[i] = step.result()
+                            scores[i] += rewards[i]
+                            steps[i] += 1
+                        if not done:
+                            action = env.timed('agent', agent.step_env, i, observations[i], rewards[i], False, infos[i])
+                            pending_steps[i] = self.submit_step(env, action)
+                    except Exception as e:
+                        print(e)
+                        if environment.env.debug: raise(e)
+                        crashed = True
+
+                    if not (done or crashed):
+                        continue
+
+                    run_state = agent.agents[i].run_state
+                    latency = env.latency
+                    try:
+                        if not crashed:
+                            run_state.log_final_state(rewards[i], infos[i]["is_ascended"], latency)
+                    finally:
+                        observations[i] = env.reset_environment(env.env)
+                        run_state.reset()
+
+                    yield FinishedEpisode(
+                        env_index=i,
+                        seed=seeds[i],
+                        ascended=infos[i].get("is_ascended", False),
+                        crashed=crashed,
+                        score=scores[i],
+                        steps=steps[i],
+                        wall_time=time.time() - start_times[i],
+                        latency=latency,
+                    )
+
+                    rewards[i] = 0
+                    infos[i] = {}
+                    scores[i] = 0
+                    steps[i] = 0
+                    seeds[i] = self.episode_seed(i, agent)
+                    start_times[i] = time.time()
+                    if env.out_of_seeds:
+                        live.remove(i)
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
@@ -1,4 +1,4 @@
-from agents.custom_agent import CustomAgent
+from agents.custom_agent import BatchedCustomAgent, CustomAgent
 #from agents.torchbeast_agent import TorchBeastAgent
 
 from envs.wrappers import addtimelimitwrapper_fn
@@ -17,6 +17,8 @@ class SubmissionConfig:
     ## Add your own agent class
     AGENT = CustomAgent
     # AGENT = TorchBeastAgent
+    # Used instead of AGENT when NUM_ENVIRONMENTS > 1, driving every env from one process
+    BATCHED_AGENT = BatchedCustomAgent
 
 
     ## Change the NUM_ENVIRONMENTS as you need
@@ -7,6 +7,7 @@
 
 from typing import Any, NamedTuple, List
 import csv
+import json
 from dataclasses import dataclass
 from multiprocessing import Process, Queue
 import os
@@ -19,9 +20,10 @@ from tqdm import tqdm
 
 from submission_config import SubmissionConfig, TestEvaluationConfig
 
-from envs.batched_env import InstrumentedEnv
+from envs.batched_env import BatchedInstrumentedEnv, FinishedEpisode, InstrumentedEnv, NO_MORE_SEEDS
 
 import environment
+import utilities
 import utility.parse_ttyrec as parse_ttyrec
 
 class RolloutResults(NamedTuple):
@@ -30,6 +32,96 @@ class RolloutResults(NamedTuple):
     scores: List[int]
     log_paths: str
     crash_seeds: List[Any]
+    latency: Any
+
+class EpisodeResult(NamedTuple):
+    runner: int
+    seed: Any
+    score: int
+    ascended: bool
+    crashed: bool
+    steps: int
+    wall_time: float
+    # Step latency histograms by kind, as LatencyHistogram.to_dict() so they survive JSON
+    latency: Any = None
+
+class RunnerDone(NamedTuple):
+    runner: int
+    log_paths: List[str]
+
+def empty_results():
+    return RolloutResults(
+        runners=0,
+        ascensions=0,
+        scores=[],
+        log_paths=[],
+        crash_seeds=[],
+        latency=None,
+    )
+
+def episode_results(episode: EpisodeResult):
+    latency = None
+    if episode.latency is not None:
+        latency = {kind: utilities.LatencyHistogram.from_dict(d) for kind, d in episode.latency.items()}
+    return RolloutResults(
+        runners=0,
+        ascensions=int(episode.ascended),
+        scores=[episode.score],
+        log_paths=[],
+        crash_seeds=[episode.seed] if episode.crashed else [],
+        latency=latency,
+    )
+
+def runner_done_results(done: RunnerDone):
+    return RolloutResults(
+        runners=1,
+        ascensions=0,
+        scores=[],
+        log_paths=done.log_paths,
+        crash_seeds=[],
+        latency=None,
+    )
+
+def episode_record(episode: EpisodeResult):
+    # Native types only: numpy scalars would otherwise be written as strings by default=str
+    record = episode._asdict()
+    record.update(
+        runner=int(episode.runner),
+        score=float(episode.score),
+        ascended=bool(episode.ascended),
+        crashed=bool(episode.crashed),
+        steps=int(episode.steps),
+        wall_time=float(episode.wall_time),
+    )
+    if episode.seed is not None:
+        # core and display seeds stay numbers so resuming can match them against the whitelist
+        record['seed'] = [int(s) for s in episode.seed[:2]] + [str(s) for s in episode.seed[2:]]
+    return record
+
+def record_episode(store_path, episode: EpisodeResult):
+    # One JSON object per line, appended as each episode finishes, so a killed run loses at most a torn last line
+    with open(store_path, 'a') as f:
+        f.write(json.dumps(episode_record(episode), default=str) + "\n")
+
+def load_episode_store(store_path):
+    episodes = []
+    if store_path is None or not os.path.exists(store_path):
+        return episodes
+    line = ""
+    with open(store_path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record['seed'] is not None:
+                record['seed'] = tuple(record['seed'])
+            episodes.append(EpisodeResult(**record))
+    if line and not line.endswith("\n"):
+        # Terminate a torn line so the next append starts cleanly
+        with open(store_path, 'a') as f:
+            f.write("\n")
+    return episodes
 
 seed_whitelist = []
 if environment.env.use_seed_whitelist:
@@ -50,52 +142,93 @@ def evaluate_one(agent_seed, core, disp, respond_to_issue=None):
     agent = Agent(instrumented_env.env if environment.env.log_runs else None, agent_seed, respond_to_issue)
     return instrumented_env.run_episode(agent)
 
-def evaluate(runner_index, num_episodes=TestEvaluationConfig.NUM_EPISODES, runner_queue=None):
-    env_make_fn = SubmissionConfig.MAKE_ENV_FN
-    Agent = SubmissionConfig.AGENT
-
-    seeds = seed_whitelist[(runner_index * num_episodes):((runner_index + 1) * num_episodes)]
+def make_seed_queue(num_episodes, num_runners, seed_queue, completed_episodes=[], envs_per_runner=SubmissionConfig.NUM_ENVIRONMENTS):
+    # Unseeded episodes are queued as None so every runner draws from the same pool of work
+    completed_seeds = set(e.seed[:2] for e in completed_episodes if e.seed is not None)
+    remaining = max(0, num_episodes - len(completed_episodes))
+    seeds = [s for s in seed_whitelist[:num_episodes] if s not in completed_seeds][:remaining]
+    seeds = seeds + [None] * (remaining - len(seeds))
     # If you want to manually try a single seed
     #seeds = [(571551750595234834, 425320176697420519)]
-
-    instrumented_env = InstrumentedEnv(env_make_fn=env_make_fn, seeds=seeds)
-    agent = Agent(instrumented_env.env if environment.env.log_runs else None)
-
-    ascension_count = 0
-    scores = []
-    crash_seeds = []
-    episode_count = 0
-    pbar = tqdm(total=num_episodes)
-
-    while episode_count < num_episodes:
+    for seed in seeds:
+        seed_queue.put(seed)
+    # Every env of every runner stops at the first NO_MORE_SEEDS it draws, so each needs its own
+    for _ in range(num_runners * envs_per_runner):
+        seed_queue.put(NO_MORE_SEEDS)
+    return seed_queue
+
+def single_env_episodes(instrumented_env, agent):
+    while not instrumented_env.out_of_seeds:
         seed = None
         if instrumented_env.seeded():
             core, disp, _ = instrumented_env.env.get_seeds()
             seed = (core, disp, agent.run_state.seed)
-        ascension, crashed, score = instrumented_env.run_episode(agent)
-        scores.append(score)
-        ascension_count += int(ascension)
-        if crashed:
-            crash_seeds.append(seed)
-        episode_count += 1
+        start_time = time.time()
+        ascension, crashed, score, steps, latency = instrumented_env.run_episode(agent)
+        yield FinishedEpisode(
+            env_index=0,
+            seed=seed,
+            ascended=ascension,
+            crashed=crashed,
+            score=score,
+            steps=steps,
+            wall_time=time.time() - start_time,
+            latency=latency,
+        )
+
+def evaluate(runner_index, seed_queue, results_queue=None):
+    env_make_fn = SubmissionConfig.MAKE_ENV_FN
+
+    if SubmissionConfig.NUM_ENVIRONMENTS > 1:
+        batched_env = BatchedInstrumentedEnv(
+            env_make_fn=env_make_fn,
+            num_envs=SubmissionConfig.NUM_ENVIRONMENTS,
+            seed_queue=seed_queue,
+            pipelined=environment.env.pipeline_envs,
+        )
+        envs = [instrumented_env.env for instrumented_env in batched_env.envs]
+        Agent = SubmissionConfig.BATCHED_AGENT
+        agent = Agent(len(envs), batched_env.num_actions, envs if environment.env.log_runs else None)
+        episodes = batched_env.run_episodes(agent)
+    else:
+        instrumented_env = InstrumentedEnv(env_make_fn=env_make_fn, seed_queue=seed_queue)
+        envs = [instrumented_env.env]
+        Agent = SubmissionConfig.AGENT
+        agent = Agent(instrumented_env.env if environment.env.log_runs else None)
+        episodes = single_env_episodes(instrumented_env, agent)
+
+    results = empty_results()
+    # When streaming to run_multiple, progress is reported by the parent
+    pbar = tqdm(disable=results_queue is not None)
+
+    for finished in episodes:
+        episode = EpisodeResult(
+            runner=runner_index,
+            seed=finished.seed,
+            score=finished.score,
+            ascended=bool(finished.ascended),
+            crashed=finished.crashed,
+            steps=finished.steps,
+            wall_time=finished.wall_time,
+            latency={kind: h.to_dict() for kind, h in finished.latency.items()} if finished.latency else None,
+        )
+        results = merge_results(results, episode_results(episode))
+        if results_queue:
+            results_queue.put(episode)
+        elif environment.env.results_store:
+            record_episode(environment.env.results_store, episode)
         pbar.update(1)
 
     pbar.close()
 
     log_paths = []
     if environment.env.log_runs:
-        log_paths.append(instrumented_env.env.savedir)
+        log_paths.extend(env.savedir for env in envs)
 
-    results = RolloutResults(
-        runners=1,
-        ascensions=ascension_count,
-        scores=scores,
-        log_paths=log_paths,
-        crash_seeds=crash_seeds,
-    )
-
-    if runner_queue:
-        runner_queue.put(results)
+    done = RunnerDone(runner=runner_index, log_paths=log_paths)
+    results = merge_results(results, runner_done_results(done))
+    if results_queue:
+        results_queue.put(done)
 
     return results
 
@@ -103,7 +236,6 @@ def evaluate(runner_index, num_episodes=TestEvaluationConfig.NUM_EPISODES, runne
 class Runner:
     id: int
     process: Process
-    queue: Queue
     done: bool = False
 
 def merge_results(results_1: RolloutResults, results_2: RolloutResults):
@@ -113,24 +245,25 @@ def merge_results(results_1: RolloutResults, results_2: RolloutResults):
         scores=results_1.scores + results_2.scores,
         log_paths=results_1.log_paths + results_2.log_paths,
         crash_seeds=results_1.crash_seeds + results_2.crash_seeds,
+        latency=merge_latency(results_1.latency, results_2.latency),
     )
 
-def run_multiple(num_runners):
-    overall_results = RolloutResults(
-        runners=0,
-        ascensions=0,
-        scores=[],
-        log_paths=[],
-        crash_seeds=[],
-    )
+def merge_latency(latency_1, latency_2):
+    if latency_1 is None:
+        return latency_2
+    if latency_2 is None:
+        return latency_1
+    return utilities.merge_step_latency(latency_1, latency_2)
+
+def run_multiple(num_runners, completed_episodes=[]):
+    overall_results = empty_results()
+    seed_queue = make_seed_queue(TestEvaluationConfig.NUM_EPISODES, num_runners, Queue(), completed_episodes)
+    results_queue = Queue()
     runners : List[Runner] = []
-    episodes_per_runner = TestEvaluationConfig.NUM_EPISODES // num_runners + 1
     for i in range(0, num_runners):
-        runner_queue = Queue()
         runner = Runner(
             id=i,
-            process=Process(target=evaluate, args=(i, episodes_per_runner, runner_queue)),
-            queue=runner_queue,
+            process=Process(target=evaluate, args=(i, seed_queue, results_queue)),
         )
         runners.append(runner)
 
@@ -139,33 +272,118 @@ def run_multiple(num_runners):
 
     done_runners = 0
     crashed_runners = 0
+    total_steps = 0
+    start_time = time.time()
+    pbar = tqdm(total=TestEvaluationConfig.NUM_EPISODES, initial=len(completed_episodes))
 
     while done_runners < num_runners:
-        time.sleep(30)
-        for runner in runners:
-            if runner.done:
-                continue
-            runner.process.join(timeout=1)
-            if runner.process.exitcode is not None:
-                try:
-                    new_results = runner.queue.get(timeout=1)
-                    overall_results = merge_results(overall_results, new_results)
-                except queue.Empty:
-                    crashed_runners += 1
-                    pass
+        # A runner that has exited has already flushed anything it put on results_queue,
+        # so if the queue comes up empty after it exited, it died without reporting
+        exited = [r for r in runners if not r.done and r.process.exitcode is not None]
+        try:
+            message = results_queue.get(timeout=1 if exited else 30)
+        except queue.Empty:
+            for runner in exited:
+                crashed_runners += 1
                 runner.done = True
                 done_runners += 1
+            continue
+
+        if isinstance(message, RunnerDone):
+            overall_results = merge_results(overall_results, runner_done_results(message))
+            runners[message.runner].done = True
+            runners[message.runner].process.join()
+            done_runners += 1
+            continue
+
+        overall_results = merge_results(overall_results, episode_results(message))
+        if environment.env.results_store:
+            record_episode(environment.env.results_store, message)
+        total_steps += message.steps
+        elapsed = time.time() - start_time
+        pbar.update(1)
+        pbar.set_postfix(
+            steps_per_sec=f"{total_steps / elapsed:.0f}",
+            episodes_per_hour=f"{3600 * (pbar.n - len(completed_episodes)) / elapsed:.0f}",
+            ascensions=overall_results.ascensions,
+        )
 
-    return overall_results, crashed_runners, episodes_per_runner
-
+    pbar.close()
+    return overall_results, crashed_runners
+
+def junk_ttyrec(ttyrec_files):
+    # Every runner resets into one extra episode after its last real one; that ttyrec is the highest numbered
+    def episode_number(f):
+        return int(os.path.basename(f)[:-len('.ttyrec.bz2')].split('.')[-1])
+    if not ttyrec_files:
+        return None
+    return max(ttyrec_files, key=episode_number)
+
+def merge_json_logs(log_paths, filename):
+    # Sums the per-episode {name: {field: number}} entries that RunState.extend_json wrote into each log path
+    merged = {}
+    for path in log_paths:
+        try:
+            with open(os.path.join(path, filename), 'r') as f:
+                episodes = json.load(f)
+        except FileNotFoundError:
+            continue
+        for episode in episodes.values():
+            for name, fields in episode.items():
+                totals = merged.setdefault(name, {})
+                for field, value in fields.items():
+                    totals[field] = totals.get(field, 0) + value
+    return merged
+
+def print_stage_timings(stage_timings):
+    if not stage_timings:
+        return
+    total_seconds = stage_timings.get('generate_action', {}).get('seconds', 0)
+    total_calls = stage_timings.get('generate_action', {}).get('calls', 0)
+    print("Stage timings (cumulative over all runs):")
+    for name, t in sorted(stage_timings.items(), key=lambda item: -item[1]['seconds']):
+        if t['seconds'] == 0:
+            # Counted rather than timed, so report how often per step instead
+            per_step = f"{t['calls'] / total_calls:.2f}/step" if total_calls else "-"
+            print(f"  {name:<20} {'':>11} {t['calls']:10d} times {per_step:>25}")
+            continue
+        share = f"{100 * t['seconds'] / total_seconds:.1f}%" if total_seconds else "-"
+        print(f"  {name:<20} {t['seconds']:10.1f}s {t['calls']:10d} calls {1000 * t['seconds'] / t['calls']:8.3f}ms/call {share:>7}")
+
+def print_memo_stats(memo_stats):
+    if not memo_stats:
+        return
+    print("Character memo (recomputed when AC, level, intrinsics, inventory or attributes change):")
+    for name, m in sorted(memo_stats.items(), key=lambda item: -(item[1]['hits'] + item[1]['misses'])):
+        print(f"  {name:<20} {m['hits']:10d} hits {m['misses']:10d} misses {m['hits'] / (m['hits'] + m['misses']):8.1%} hit rate")
+
+def print_advisor_costs(advisor_costs, top=25):
+    if not advisor_costs:
+        return
+    print("Most expensive advisors (inclusive of children; fire rate is advised / calls):")
+    for label, c in sorted(advisor_costs.items(), key=lambda item: -item[1]['seconds'])[:top]:
+        print(
+            f"  {label:<70} {c['seconds']:9.1f}s {c['calls']:9d} calls "
+            f"{1000 * c['seconds'] / c['calls']:7.3f}ms/call "
+            f"rejected {c['rejected'] / c['calls']:6.1%} fired {c['advised'] / c['calls']:6.1%}"
+        )
 
 if __name__ == "__main__":
+    # Episodes already finished by an earlier, interrupted run with the same results store
+    completed_episodes = load_episode_store(environment.env.results_store)
+    if completed_episodes:
+        print(f"Resuming from {environment.env.results_store} with {len(completed_episodes)} completed episodes")
     if environment.env.num_runners > 1:
-        overall_results, crashed_runners, episodes_per_runner = run_multiple(environment.env.num_runners)
+        overall_results, crashed_runners = run_multiple(environment.env.num_runners, completed_episodes)
     else:
-        overall_results = evaluate(0, TestEvaluationConfig.NUM_EPISODES)
-        episodes_per_runner = TestEvaluationConfig.NUM_EPISODES
+        overall_results = evaluate(0, make_seed_queue(TestEvaluationConfig.NUM_EPISODES, 1, queue.Queue(), completed_episodes))
         crashed_runners = 0
+    for episode in completed_episodes:
+        overall_results = merge_results(overall_results, episode_results(episode))
+    if overall_results.latency is not None:
+        print("Step latency across all runners: " + ", ".join(
+            f"{k}: {v:.3f}" for k, v in utilities.step_latency_summary_ms(overall_results.latency).items() if v is not None
+        ))
     if environment.env.log_runs:
         print(
             f"Runners: {overall_results.runners}, "
@@ -186,10 +404,10 @@ if __name__ == "__main__":
 
         for path in overall_results.log_paths:
             files = [os.path.join(path,f) for f in os.listdir(path) if os.path.isfile(os.path.join(path,f)) and f.endswith('.ttyrec.bz2')]
-            for f in files:
-                if f.endswith('{}.ttyrec.bz2'.format(episodes_per_runner)): # rm this junk file
-                    print("Removing {}".format(f))
-                    os.remove(f)
+            junk_file = junk_ttyrec(files)
+            if junk_file is not None:
+                print("Removing {}".format(junk_file))
+                os.remove(junk_file)
             outpath = os.path.join(path, "deaths.csv")
             try:
                 score_df = parse_ttyrec.parse_dir(path, outpath=outpath)
@@ -203,6 +421,11 @@ if __name__ == "__main__":
                 else:
                     joint_log_df = joint_log_df.append(df, ignore_index=True)
 
+        if environment.env.profile_stages:
+            print_stage_timings(merge_json_logs(overall_results.log_paths, "stage_timings.json"))
+            print_memo_stats(merge_json_logs(overall_results.log_paths, "character_memo.json"))
+            print_advisor_costs(merge_json_logs(overall_results.log_paths, "advisor_costs.json"))
+
         if joint_log_df is not None:
             parse_ttyrec.print_stats_from_log(joint_log_df)
 
@@ -1,23 +1,34 @@
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 import enum
+import json
+import os
+import queue
+import tempfile
+import threading
 from typing import NamedTuple
 import numpy as np
+import scipy.signal
 
 from nle import nethack
 
 import agents.representation.constants as constants
 import agents.representation.inventory as inv
 import agents.representation.map as map
+import agents.representation.morphology as morphology
 import agents.representation.monster_messages as monster_messages
+import agents.representation.physics as physics
 import agents.advice.preferences as preferences
 import agents.advice.menuplan as menuplan
 import agents.representation.neighborhood as neighborhood
 import agents.representation.glyphs as gd
 import agents.representation.threat as threat
 import agents.custom_agent
+import envs.batched_env as batched_env
+import test_submission
 import environment
+import utilities
 
 environment.env = environment.make_environment(log_runs=False)
 
@@ -365,6 +376,25 @@ class TestInnateIntrinsics(unittest.TestCase):
         self.assertTrue(character.has_intrinsic(constants.Intrinsics.poison_resistance))
         self.assertFalse(character.has_intrinsic(constants.Intrinsics.warning))
 
+    def test_version(self):
+        character = agents.custom_agent.Character(
+            base_class=constants.BaseRole.Tourist,
+            base_race=constants.BaseRace.human,
+            base_sex='male',
+            base_alignment='neutral'
+        )
+        version = character.version
+        self.assertEqual(character.speed(), 12)
+        character.add_noninnate_intrinsic(constants.Intrinsics.speed)
+        self.assertGreater(character.version, version)
+        self.assertEqual(character.speed(), 16)
+
+        version = character.version
+        character.current_hp = 3
+        character.AC = character.AC
+        self.assertEqual(character.version, version)
+        self.assertEqual(character.derived.to_dict()['speed'], {'hits': 0, 'misses': 2})
+
 
 def make_glyphs(vals = {}):
     glyphs = np.full(constants.GLYPHS_SHAPE, 2359)
@@ -388,11 +418,62 @@ class TestDLevelMap(unittest.TestCase):
         self.assertEqual(self.lmap.get_dungeon_glyph((0, 0)), upstair)
         self.assertEqual(self.lmap.get_dungeon_glyph((1, 1)), None)
 
+    def test_incremental_update(self):
+        self.lmap.verify_incremental_updates = True
+        upstair = gd.get_by_name(gd.CMapGlyph, 'upstair')
+        fountain = gd.get_by_name(gd.CMapGlyph, 'fountain')
+        room = gd.get_by_name(gd.CMapGlyph, 'room')
+        monster = gd.get_by_name(gd.MonsterAlikeGlyph, 'fire ant')
+        self.lmap.update(True, 0, (1,1), make_glyphs({(0, 0): upstair.numeral, (1, 1): room.numeral}))
+        self.lmap.update(True, 0, (1,1), make_glyphs({(0, 0): monster.numeral, (1, 1): room.numeral, (5, 5): fountain.numeral}))
+        self.assertTrue(self.lmap.fountain_map[(5, 5)])
+        self.assertTrue(self.lmap.adjacent_to_fog[(4, 4)])
+        self.lmap.update(True, 0, (1,1), make_glyphs({(0, 0): monster.numeral, (1, 1): room.numeral, (5, 5): fountain.numeral}))
+        self.lmap.add_feature((2, 2), upstair)
+        self.lmap.update(True, 0, (1,1), make_glyphs({(0, 0): upstair.numeral, (1, 1): room.numeral, (20, 78): room.numeral}))
+        self.assertEqual(self.lmap.get_dungeon_glyph((2, 2)), upstair)
+        self.assertFalse(self.lmap.fog_of_war[(20, 78)])
+        self.assertEqual(self.lmap.get_dungeon_glyph((5, 5)), fountain)
+
+    def test_special_room_grows_with_floor(self):
+        room = gd.get_by_name(gd.CMapGlyph, 'room')
+        floor = {(r, c): room.numeral for r in range(3, 6) for c in range(3, 6)}
+        floor[(10, 10)] = room.numeral
+        self.lmap.update(True, 0, (4, 4), make_glyphs(floor))
+        self.lmap.add_room_from_square((4, 4), constants.SpecialRoomTypes.shop)
+        shop = self.lmap.special_room_map == constants.SpecialRoomTypes.shop.value
+        self.assertEqual(np.count_nonzero(shop), 9)
+        self.assertFalse(shop[(10, 10)])
+
+        self.lmap.update(True, 0, (4, 4), make_glyphs(floor))
+        self.assertFalse(self.lmap.special_rooms_need_expanding)
+        floor.update({(6, c): room.numeral for c in range(3, 6)})
+        self.lmap.update(True, 0, (4, 4), make_glyphs(floor))
+        shop = self.lmap.special_room_map == constants.SpecialRoomTypes.shop.value
+        self.assertEqual(np.count_nonzero(shop), 12)
+        self.assertFalse(shop[(10, 10)])
+
     def test_add_feature(self):
         upstair = gd.get_by_name(gd.CMapGlyph, 'upstair')
         self.assertEqual(self.lmap.get_dungeon_glyph((0, 0)), None)
         self.lmap.add_feature((0,0), upstair)
         self.assertEqual(self.lmap.get_dungeon_glyph((0, 0)), upstair)
+        self.assertEqual(self.lmap.upstairs_count, 1)
+
+    def test_feature_counts(self):
+        upstair = gd.get_by_name(gd.CMapGlyph, 'upstair')
+        downstair = gd.get_by_name(gd.CMapGlyph, 'dnstair')
+        fountain = gd.get_by_name(gd.CMapGlyph, 'fountain')
+        self.lmap.update(True, 0, (1,1), make_glyphs({(0, 0): upstair.numeral, (3, 3): fountain.numeral, (4, 4): fountain.numeral}))
+        self.assertEqual((self.lmap.upstairs_count, self.lmap.downstairs_count), (1, 0))
+        self.assertEqual(self.lmap.feature_count(fountain), 2)
+        self.lmap.update(True, 0, (1,1), make_glyphs({(0, 0): upstair.numeral, (3, 3): downstair.numeral, (4, 4): fountain.numeral}))
+        self.assertEqual((self.lmap.upstairs_count, self.lmap.downstairs_count), (1, 1))
+        self.assertEqual(self.lmap.feature_count(fountain, downstair), 2)
+        self.lmap.add_feature((5, 5), upstair)
+        self.assertEqual(self.lmap.upstairs_count, 2)
+        self.assertEqual(self.lmap.upstairs_target, 2)
+        self.assertTrue((self.lmap.feature_counts == np.bincount(self.lmap.dungeon_feature_map.ravel(), minlength=self.lmap.feature_counts.size)).all())
 
     def test_add_traversed_staircase(self):
         downstair = gd.get_by_name(gd.CMapGlyph, 'dnstair')
@@ -540,6 +621,29 @@ class TestCMapGlyphs(unittest.TestCase):
             glyph = gd.GLYPH_NAME_LOOKUP[k]
             self.assertEqual(gd.walkable(np.array(glyph.numeral)), v, k)
 
+    def test_lookup_masks(self):
+        glyphs = np.array([
+            [gd.GLYPH_NAME_LOOKUP['room'].numeral, gd.GLYPH_NAME_LOOKUP['vcdoor'].numeral, gd.GLYPH_NAME_LOOKUP['shopkeeper'].numeral],
+            [gd.GLYPH_NAME_LOOKUP['boulder'].numeral, gd.InvisibleGlyph.OFFSET, gd.CorpseGlyph.OFFSET],
+        ], dtype=np.int16)
+        self.assertTrue((gd.walkable(glyphs) == np.array([[True, False, False], [True, False, True]])).all())
+        self.assertTrue((gd.monster_like_mask(glyphs) == np.array([[False, False, True], [False, True, False]])).all())
+        self.assertTrue((gd.stackable_mask(glyphs) == np.array([[False, False, False], [True, False, True]])).all())
+        self.assertTrue((gd.MonsterGlyph.always_peaceful_mask(glyphs) == np.array([[False, False, True], [False, False, False]])).all())
+        self.assertTrue((gd.CMapGlyph.closed_door_mask(glyphs) == np.array([[False, True, False], [False, False, False]])).all())
+        # Offsets of non-CMap glyphs still answer as the offset arithmetic would
+        self.assertTrue((gd.CMapGlyph.is_wall_check(glyphs - gd.CMapGlyph.OFFSET) == np.array([[False, False, True], [True, True, True]])).all())
+
+    def test_glyph_frame(self):
+        glyphs = make_glyphs({(3, 4): gd.GLYPH_NAME_LOOKUP['newt'].numeral})
+        frame = gd.GlyphFrame(glyphs)
+        view = frame.view((slice(2, 5), slice(3, 6)))
+        self.assertTrue(view.layer('monster_like')[1, 1])
+        self.assertEqual(np.count_nonzero(frame.layer('monster_like')), 1)
+        self.assertEqual((frame.requested, frame.computed), (2, 1))
+        with self.assertRaises(ValueError):
+            view.layer('monster_like')[1, 1] = False
+
     def test_room_floor(self):
         true_labels = {
             'stone': False, # 0
@@ -663,6 +767,16 @@ class TestThreat(NeighborhoodBuildingTest):
         c.current_hp = 50
         return c
 
+    def test_raytrace_from(self):
+        grid = np.full((5, 5), gd.get_by_name(gd.CMapGlyph, 'room').numeral)
+        grid[2, 2] = gd.get_by_name(gd.CMapGlyph, 'vwall').numeral
+        can_hit = map.ThreatMap.raytrace_from((2, 0), grid)
+        self.assertTrue(can_hit[2, 2])
+        self.assertFalse(can_hit[2, 3])
+        self.assertFalse(can_hit[2, 1])
+        self.assertTrue(can_hit[4, 2])
+        self.assertTrue(map.ThreatMap.raytrace_from((2, 0), grid, include_adjacent=True)[2, 1])
+
     def get_spoiler(self, name):
         monster = gd.GLYPH_NAME_LOOKUP[name]
         spoiler = monster.monster_spoiler
@@ -684,6 +798,23 @@ class TestThreat(NeighborhoodBuildingTest):
         self.assertTrue(0 < self.melee_threat('fire ant', resist_c).damage < self.melee_threat('fire ant', c).damage)
         self.assertEqual(0, self.melee_threat('flaming sphere', resist_c).damage)
 
+    def test_damage_table(self):
+        c = self.make_character()
+        spoiler = self.get_spoiler('soldier ant')
+        self.assertEqual(spoiler.expected_melee_damage_to_character(c), spoiler.calculate_melee_damage_to_character(c))
+        self.assertEqual(self.ranged_threat('black dragon', c).threat_type, threat.ThreatTypes.DISINTEGRATE)
+        c.innate_intrinsics = constants.Intrinsics.reflection
+        self.assertEqual(self.ranged_threat('black dragon', c).threat_type, threat.ThreatTypes.NO_SPECIAL)
+
+    def test_unmeleeable_glyphs(self):
+        c = self.make_character()
+        unmeleeable = c.unmeleeable_glyphs()
+        self.assertTrue(unmeleeable[gd.GLYPH_NAME_LOOKUP['floating eye'].numeral])
+        self.assertFalse(unmeleeable[gd.GLYPH_NAME_LOOKUP['newt'].numeral])
+        self.assertFalse(unmeleeable[gd.InvisibleGlyph.OFFSET])
+        for numeral in gd.MonsterGlyph.numerals():
+            self.assertEqual(unmeleeable[numeral], not gd.GLYPH_NUMERAL_LOOKUP[numeral].monster_spoiler.char_would_tussle_with(c))
+
     def test_reflect(self):
         c = self.make_character()
         reflect_c = self.make_character(constants.Intrinsics.reflection)
@@ -1612,6 +1743,65 @@ class TestSpecialItemNames(unittest.TestCase):
         self.assertEqual(item.charges, 0)
 
 class TestFloodMap(unittest.TestCase):
+    def test_walking_distances(self):
+        walkable = np.array([
+            [True, True, True, True],
+            [False, False, True, True],
+            [True, True, True, False],
+            [False, False, False, True],
+        ])
+        doors = np.full_like(walkable, False)
+        doors[1, 2] = True
+        distances = map.FloodMap.walking_distances((0, 0), walkable, doors)
+        self.assertTrue((distances == np.array([
+            [0, 1, 2, 3],
+            [-1, -1, 3, 3],
+            [6, 5, 4, -1],
+            [-1, -1, -1, 5],
+        ])).all(), distances)
+        self.assertEqual(map.FloodMap.walking_distances((0, 0), walkable, doors, diagonal=False)[3, 3], -1)
+
+class TestMorphology(unittest.TestCase):
+    def test_flood_masks(self):
+        masks = np.full((3, 5, 5), False)
+        masks[0, 0, 0] = True
+        masks[1, 2, 2] = True
+        masks[2, 4, 4] = True
+        flooded = morphology.dilate(masks)
+        for mask, end_mask in zip(masks, flooded):
+            self.assertTrue((end_mask == morphology.dilate(mask)).all())
+
+    def test_neighbor_counts(self):
+        mask = np.random.default_rng(0).random((21, 79)) < 0.3
+        expected = scipy.signal.convolve2d(mask, np.ones((3,3)), mode='same')
+        self.assertTrue((morphology.neighbor_counts(mask) == expected).all())
+        self.assertTrue((morphology.dilate(mask) == (expected >= 1)).all())
+
+    def test_flood_fill(self):
+        within = np.array([
+            [True, True, False, False, True],
+            [False, True, False, False, True],
+            [False, False, True, False, False],
+            [True, False, False, False, True],
+        ])
+        seeds = np.full_like(within, False)
+        seeds[0, 0] = True
+        labels, count = morphology.label_components(within)
+        self.assertEqual(count, 4)
+        expected = np.array([
+            [True, True, False, False, False],
+            [False, True, False, False, False],
+            [False, False, True, False, False],
+            [False, False, False, False, False],
+        ])
+        self.assertTrue((morphology.flood_fill(seeds, within) == expected).all())
+        self.assertTrue((morphology.flood_fill(seeds, within, labels) == expected).all())
+        two_steps = np.full_like(within, False)
+        two_steps[0:2, 0:2] = within[0:2, 0:2]
+        self.assertTrue((morphology.dilate_n(seeds, 1, within) == two_steps).all())
+        self.assertTrue((morphology.dilate_n(seeds, 5, within) == expected).all())
+        self.assertFalse(morphology.flood_fill(np.full_like(within, False), within).any())
+
     def test_flood_center(self):
         start_mask = np.array([
             [False, False, False, False],
@@ -1625,7 +1815,7 @@ class TestFloodMap(unittest.TestCase):
             [True, True, True, False],
             [False, False, False, False],
         ])
-        end_mask = map.FloodMap.flood_one_level_from_mask(start_mask)
+        end_mask = morphology.dilate(start_mask)
         self.assertTrue((end_mask == target_mask).all(), end_mask)
         self.assertEqual(end_mask.dtype, np.dtype('bool'))
 
@@ -1642,7 +1832,7 @@ class TestFloodMap(unittest.TestCase):
             [True, True, True, True],
             [False, True, True, True],
         ])
-        end_mask = map.FloodMap.flood_one_level_from_mask(start_mask)
+        end_mask = morphology.dilate(start_mask)
         self.assertTrue((end_mask == target_mask).all(), end_mask)
         self.assertEqual(end_mask.dtype, np.dtype('bool'))
 
@@ -1659,7 +1849,7 @@ class TestFloodMap(unittest.TestCase):
             [True, True, False, False],
             [False, False, False, False],
         ])
-        end_mask = map.FloodMap.flood_one_level_from_mask(start_mask)
+        end_mask = morphology.dilate(start_mask)
         self.assertTrue((end_mask == target_mask).all(), end_mask)
         self.assertEqual(end_mask.dtype, np.dtype('bool'))
 
@@ -1676,10 +1866,261 @@ class TestFloodMap(unittest.TestCase):
             [False, False, False, False],
             [False, False, False, False],
         ])
-        end_mask = map.FloodMap.flood_one_level_from_mask(start_mask)
+        end_mask = morphology.dilate(start_mask)
         self.assertTrue((end_mask == target_mask).all(), end_mask)
         self.assertEqual(end_mask.dtype, np.dtype('bool'))
 
+class TestLatencyHistogram(unittest.TestCase):
+    def test_log_header(self):
+        self.assertEqual(agents.custom_agent.RunState().log_header, agents.custom_agent.RunState.LOG_HEADER)
+        with patch.object(environment, 'env', environment.env._replace(time_steps=True)):
+            self.assertEqual(agents.custom_agent.RunState().log_header[-len(utilities.STEP_LATENCY_LOG_HEADER):], utilities.STEP_LATENCY_LOG_HEADER)
+
+    def test_percentiles(self):
+        h = utilities.LatencyHistogram()
+        for ms in range(1, 101):
+            h.record(ms / 1000)
+        self.assertAlmostEqual(h.percentile(50), 0.050, delta=0.005)
+        self.assertAlmostEqual(h.percentile(99), 0.099, delta=0.009)
+        self.assertEqual(h.percentile(100), 0.100)
+
+    def test_merge_round_trip(self):
+        h1 = utilities.LatencyHistogram()
+        h2 = utilities.LatencyHistogram()
+        for _ in range(10):
+            h1.record(0.001)
+            h2.record(0.1)
+        merged = utilities.LatencyHistogram.from_dict(json.loads(json.dumps(h1.to_dict()))).merge(h2)
+        self.assertEqual(merged.total(), 20)
+        self.assertEqual(merged.max_seconds, 0.1)
+        self.assertLess(merged.percentile(50), 0.002)
+
+class FakeNLE:
+    # Episodes last as many steps as the env's index plus two, scoring a point a step
+    def __init__(self, episode_length):
+        self.action_space = MagicMock(n=3)
+        self.unwrapped = self
+        self.episode_length = episode_length
+        self.t = 0
+
+    def seed(self, core, disp, reseed):
+        pass
+
+    def reset(self):
+        self.t = 0
+        return self.t
+
+    def step(self, action):
+        self.t += 1
+        return self.t, 1, self.t >= self.episode_length, {'is_ascended': False}
+
+class FakeBatchedAgent:
+    def __init__(self, num_envs):
+        self.agents = [MagicMock() for _ in range(num_envs)]
+
+    def step_env(self, i, observation, reward, done, info):
+        return 0
+
+class TestBatchedEnv(unittest.TestCase):
+    def run_to_completion(self, num_episodes, num_envs, pipelined=False):
+        seed_queue = test_submission.make_seed_queue(num_episodes, 1, queue.Queue(), envs_per_runner=num_envs)
+        lengths = iter(range(2, num_envs + 2))
+        batched = batched_env.BatchedInstrumentedEnv(lambda: FakeNLE(next(lengths)), num_envs, seed_queue=seed_queue, pipelined=pipelined)
+        episodes = []
+        # Run on a thread so a queue that never runs dry fails the test instead of hanging it
+        runner = threading.Thread(target=lambda: episodes.extend(batched.run_episodes(FakeBatchedAgent(num_envs))), daemon=True)
+        runner.start()
+        runner.join(timeout=10)
+        self.assertFalse(runner.is_alive(), "run_episodes never ran out of seeds")
+        self.assertTrue(seed_queue.empty())
+        return episodes
+
+    def test_drains_finite_queue(self):
+        episodes = self.run_to_completion(3, 2)
+        self.assertEqual(len(episodes), 3)
+        self.assertEqual(sorted((e.env_index, e.score, e.steps) for e in episodes), [(0, 2, 2), (0, 2, 2), (1, 3, 3)])
+
+    def test_pipelined_matches_unpipelined(self):
+        episodes = self.run_to_completion(7, 3)
+        pipelined_episodes = self.run_to_completion(7, 3, pipelined=True)
+        self.assertEqual(len(pipelined_episodes), 7)
+        self.assertEqual(
+            [(e.env_index, e.score, e.steps, e.crashed) for e in pipelined_episodes],
+            [(e.env_index, e.score, e.steps, e.crashed) for e in episodes],
+        )
+
+class TestEpisodeStore(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store_path = os.path.join(directory.name, "episodes.jsonl")
+
+    def episode(self, seed, score):
+        return test_submission.EpisodeResult(
+            runner=np.int64(0),
+            seed=seed,
+            score=np.float32(score),
+            ascended=np.bool_(False),
+            crashed=False,
+            steps=np.int64(100),
+            wall_time=np.float64(1.5),
+        )
+
+    def test_resume(self):
+        test_submission.record_episode(self.store_path, self.episode((np.int64(1), np.int64(2), b'abc'), 10.5))
+        test_submission.record_episode(self.store_path, self.episode(None, 20))
+        episodes = test_submission.load_episode_store(self.store_path)
+        self.assertEqual(len(episodes), 2)
+        self.assertEqual(episodes[0].seed, (1, 2, "b'abc'"))
+        self.assertEqual([e.score for e in episodes], [10.5, 20.0])
+        self.assertEqual([type(e.steps) for e in episodes], [int, int])
+        results = test_submission.empty_results()
+        for episode in episodes:
+            results = test_submission.merge_results(results, test_submission.episode_results(episode))
+        self.assertEqual(np.mean(results.scores), 15.25)
+        self.assertEqual(min(results.scores), 10.5)
+
+    def test_skips_completed_seeds(self):
+        test_submission.record_episode(self.store_path, self.episode((1, 2, b'abc'), 10))
+        completed = test_submission.load_episode_store(self.store_path)
+        with patch.object(test_submission, 'seed_whitelist', [(1, 2), (3, 4), (5, 6)]):
+            seed_queue = test_submission.make_seed_queue(3, 1, queue.Queue(), completed, envs_per_runner=2)
+        queued = [seed_queue.get() for _ in range(seed_queue.qsize())]
+        self.assertEqual(queued, [(3, 4), (5, 6), batched_env.NO_MORE_SEEDS, batched_env.NO_MORE_SEEDS])
+
+    def test_torn_last_line(self):
+        test_submission.record_episode(self.store_path, self.episode(None, 10))
+        with open(self.store_path, 'a') as f:
+            f.write('{"runner": 0, "seed": nu')
+        self.assertEqual(len(test_submission.load_episode_store(self.store_path)), 1)
+        test_submission.record_episode(self.store_path, self.episode(None, 30))
+        self.assertEqual([e.score for e in test_submission.load_episode_store(self.store_path)], [10.0, 30.0])
+
+class TestTypedPhrase(unittest.TestCase):
+    class MockMessage(NamedTuple):
+        message: str
+        yn_question: bool = False
+        getline: bool = True
+        has_more: bool = False
+
+    def prompt(self, getline=True):
+        return {
+            'tty_chars': np.zeros((24, 80), dtype=np.uint8),
+            'misc': np.array([0, 1 if getline else 0, 0]),
+        }
+
+    def test_drains_phrase(self):
+        run_state = agents.custom_agent.RunState()
+        run_state.set_menu_plan(menuplan.MenuPlan("name", None, [menuplan.PhraseMenuResponse("What do you want to name", "ab")]))
+        self.assertEqual(run_state.run_menu_plan(self.MockMessage("What do you want to name this?")), ord('a'))
+        self.assertEqual(run_state.next_typed_key(self.prompt()), ord('b'))
+        self.assertEqual(run_state.next_typed_key(self.prompt()), ord('\r'))
+        self.assertIsNone(run_state.next_typed_key(self.prompt()))
+
+    def test_bails_out_when_prompt_gone(self):
+        run_state = agents.custom_agent.RunState()
+        run_state.set_menu_plan(menuplan.MenuPlan("name", None, [menuplan.PhraseMenuResponse("What do you want to name", "ab")]))
+        run_state.run_menu_plan(self.MockMessage("What do you want to name this?"))
+        self.assertIsNone(run_state.next_typed_key(self.prompt(getline=False)))
+        # The menu plan picks up where the phrase left off
+        self.assertEqual(run_state.run_menu_plan(self.MockMessage("What do you want to name this? a")), ord('b'))
+
+class TestTravelCursor(unittest.TestCase):
+    def move_cursor(self, start, target, hero_square=None, feature_map=None):
+        response = menuplan.TravelNavigationMenuResponse(".*", None, physics.Square(*target))
+        cursor = physics.Square(*start)
+        keypresses = 0
+        while True:
+            action = response.generate_action(cursor + (1, 0), response.target_square, hero_square, feature_map)
+            if action is None:
+                return cursor, keypresses
+            keypresses += 1
+            if action in physics.action_to_delta:
+                cursor = cursor + physics.action_to_delta[action]
+            elif action in menuplan.cursor_jump_deltas:
+                row_delta, col_delta = menuplan.cursor_jump_deltas[action]
+                cursor = cursor + (menuplan.CURSOR_JUMP * row_delta, menuplan.CURSOR_JUMP * col_delta)
+            elif action == menuplan.CURSOR_TO_SELF:
+                cursor = physics.Square(*hero_square)
+            else:
+                cursor = menuplan.next_feature_square(feature_map, cursor, menuplan.cursor_feature_keys[action])
+
+    def test_cross_map(self):
+        cursor, keypresses = self.move_cursor((0, 0), (20, 78))
+        self.assertEqual(cursor, (20, 78))
+        self.assertEqual(keypresses, 15) # vs 78 one square at a time
+
+    def test_overshoot_and_step_back(self):
+        cursor, keypresses = self.move_cursor((5, 10), (5, 17))
+        self.assertEqual(cursor, (5, 17))
+        self.assertEqual(keypresses, 2)
+
+    def test_stays_off_column_zero(self):
+        for target_col in range(1, 4):
+            self.assertNotEqual(menuplan.cursor_grid_plan(physics.Square(5, 8), physics.Square(5, target_col))[1], nethack.actions.CompassDirectionLonger.W)
+            response = menuplan.TravelNavigationMenuResponse(".*", None, physics.Square(5, target_col))
+            cursor = physics.Square(5, 8)
+            while True:
+                action = response.generate_action(cursor + (1, 0), response.target_square)
+                if action is None:
+                    break
+                self.assertNotEqual(response.expected_square.col, 0)
+                self.assertTrue(response.use_shortcuts)
+                cursor = response.expected_square
+            self.assertEqual(cursor, (5, target_col))
+
+    def test_feature_and_self_jumps(self):
+        feature_map = np.zeros(constants.GLYPHS_SHAPE, dtype=int)
+        feature_map[15, 70] = gd.get_by_name(gd.CMapGlyph, 'dnstair').numeral
+        self.assertEqual(self.move_cursor((1, 1), (15, 70), feature_map=feature_map), ((15, 70), 1))
+        self.assertEqual(self.move_cursor((18, 70), (2, 3), hero_square=(2, 2)), ((2, 3), 2))
+
+class TestPathfinder(unittest.TestCase):
+    def pathfinder(self, doors=None, failed_moves=None, diagonal=True):
+        return neighborhood.Pathfinder(
+            walkable_mesh=np.full((7, 7), True),
+            doors=doors if doors is not None else np.full((7, 7), False),
+            player_location=physics.Square(3, 3),
+            absolute_player_location=physics.Square(10, 10),
+            failed_moves=failed_moves if failed_moves is not None else neighborhood.FailedMoveRecords(),
+            diagonal=diagonal,
+        )
+
+    def test_nearest_of_many_targets(self):
+        targets = np.full((7, 7), False)
+        targets[0, 0] = True
+        targets[5, 4] = True
+        targets[6, 6] = True
+        path = self.pathfinder().path_to_nearest(targets)
+        self.assertEqual(len(path), 3)
+        self.assertEqual(path[-1], (5, 4))
+
+    def test_no_diagonal(self):
+        targets = np.full((7, 7), False)
+        targets[4, 4] = True
+        doors = np.full((7, 7), False)
+        doors[4, 4] = True
+        self.assertEqual(len(self.pathfinder(doors=doors).path_to_nearest(targets)), 3)
+        self.assertEqual(len(self.pathfinder(diagonal=False).path_to_nearest(targets)), 3)
+
+    def test_failed_move(self):
+        targets = np.full((7, 7), False)
+        targets[2, 3] = True
+        failed_moves = neighborhood.FailedMoveRecords()
+        failed_moves.add_failed_move((10, 10), 0, nethack.actions.CompassDirection.N)
+        self.assertEqual(len(self.pathfinder(failed_moves=failed_moves).path_to_nearest(targets)), 3)
+        self.assertEqual(len(self.pathfinder(failed_moves=failed_moves).least_threatening_path(targets, np.zeros((7, 7)))), 3)
+
+    def test_least_threatening_path(self):
+        targets = np.full((7, 7), False)
+        targets[3, 6] = True
+        threat = np.zeros((7, 7))
+        threat[2:5, 4] = 5.
+        self.assertEqual(len(self.pathfinder().path_to_nearest(targets)), 4)
+        path = self.pathfinder().least_threatening_path(targets, threat)
+        self.assertEqual(path[-1], (3, 6))
+        self.assertEqual(sum(threat[square] for square in path), 0.)
+
 # np.savetxt("foo.csv", ARS.rs.glyphs, delimiter=",", fmt='%s')
 sokoban_1a_observation = """2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359
 2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359,2359
@@ -1758,7 +2199,23 @@ class TestSpecialLevelLoader(unittest.TestCase):
             direction=map.DirectionThroughDungeon.down
         )
         self.assertIsNotNone(searcher.match_level(observed_level_map, player_location))
-        
+
+    def test_update_on_special_level(self):
+        special_level = map.SpecialLevelLoader.load('sokoban_1a')
+        player_location = (6, 35)
+        glyphs = string_to_glyphs(sokoban_1a_observation)
+        observed_level_map = map.DMap().make_level_map(map.DCoord(map.Branches.Sokoban, 4), 0, glyphs, player_location)
+        observed_level_map.verify_incremental_updates = True
+        observed_level_map.special_level = special_level
+        observed_level_map.sokoban_boulders = special_level.initial_boulders
+        observed_level_map.update(False, 1, player_location, glyphs)
+        moved_glyphs = glyphs.copy()
+        moved_glyphs[player_location] = glyphs[(6, 36)]
+        moved_glyphs[(6, 36)] = glyphs[player_location]
+        observed_level_map.update(False, 2, (6, 36), moved_glyphs)
+        self.assertEqual(observed_level_map.traps_to_avoid.shape, constants.GLYPHS_SHAPE)
+        self.assertEqual(observed_level_map.possible_secrets.shape, constants.GLYPHS_SHAPE)
+
     def test_sokoban_1b(self):
         special_level = map.SpecialLevelLoader.load('sokoban_1b')
         self.assertEqual(special_level.cmap_glyphs[0,0], 2359)
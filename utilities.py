@@ -1,4 +1,7 @@
+import contextlib
 import sys
+import threading
+import time
 
 import nle.nethack as nethack
 import numpy as np
@@ -10,9 +13,10 @@ if sys.version_info.minor >= 8:
 else:
     from backports.cached_property import cached_property
 
-class ActiveRunState():
+class ActiveRunState(threading.local):
+    # Thread-local so that each thread stepping agents sees the run state it is working on
     def __init__(self):
-        rs = None
+        self.rs = None
 
     def set_active(self, run_state):
         self.rs = run_state
@@ -34,7 +38,9 @@ for action in nethack.ACTIONS:
 ##################################
 
 def vectorized_map(f, nd_array):
-    return np.array(list(map(f, nd_array.ravel()))).reshape(nd_array.shape)
+    # f runs once per distinct value, and the results are spread back out through a lookup table
+    values, inverse = np.unique(nd_array, return_inverse=True)
+    return np.array([f(value) for value in values])[inverse].reshape(nd_array.shape)
 
 def centered_slices_bounded_on_array(start, radii, target_array):
     row_slice_radius, col_slice_radius = radii
@@ -68,4 +74,161 @@ def rectangle_defined_by_corners(corner1, corner2):
     row_slice = slice(min(x1,x2), max(x1,x2)+1)
     col_slice = slice(min(y1,y2), max(y1,y2)+1)
 
-    return row_slice, col_slice
\ No newline at end of file
+    return row_slice, col_slice
+
+##############
+### Timing ###
+##############
+
+class LatencyHistogram():
+    # Buckets are log spaced from MIN_SECONDS with a fixed resolution, so histograms
+    # from different episodes and runners merge by adding counts
+    MIN_SECONDS = 1e-6
+    BUCKETS_PER_DOUBLING = 8
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, counts=None, max_seconds=0.):
+        self.counts = counts if counts is not None else {}
+        self.max_seconds = max_seconds
+
+    def record(self, seconds):
+        bucket = max(0, int(np.log2(max(seconds, self.MIN_SECONDS) / self.MIN_SECONDS) * self.BUCKETS_PER_DOUBLING))
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def total(self):
+        return sum(self.counts.values())
+
+    def merge(self, other):
+        counts = dict(self.counts)
+        for bucket, count in other.counts.items():
+            counts[bucket] = counts.get(bucket, 0) + count
+        return LatencyHistogram(counts, max(self.max_seconds, other.max_seconds))
+
+    def percentile(self, p):
+        total = self.total()
+        if total == 0:
+            return None
+        seen = 0
+        for bucket in sorted(self.counts.keys()):
+            seen += self.counts[bucket]
+            if seen >= total * p / 100:
+                # Report the top of the bucket, but never more than the slowest sample actually seen
+                return min(self.MIN_SECONDS * 2 ** ((bucket + 1) / self.BUCKETS_PER_DOUBLING), self.max_seconds)
+
+    def summary_ms(self, prefix):
+        summary = {}
+        for p in self.PERCENTILES:
+            seconds = self.percentile(p)
+            summary[f'{prefix} p{p} ms'] = seconds * 1000 if seconds is not None else None
+        summary[f'{prefix} max ms'] = self.max_seconds * 1000 if self.total() > 0 else None
+        return summary
+
+    def to_dict(self):
+        return {'counts': self.counts, 'max_seconds': self.max_seconds}
+
+    @classmethod
+    def from_dict(cls, d):
+        # JSON turns the integer bucket keys into strings
+        return cls({int(k): v for k, v in d['counts'].items()}, d['max_seconds'])
+
+STEP_LATENCY_KINDS = ('agent', 'env', 'reset')
+
+def new_step_latency():
+    return {kind: LatencyHistogram() for kind in STEP_LATENCY_KINDS}
+
+def merge_step_latency(latency_1, latency_2):
+    return {kind: latency_1[kind].merge(latency_2[kind]) for kind in STEP_LATENCY_KINDS}
+
+def step_latency_summary_ms(latency):
+    summary = {}
+    for kind in STEP_LATENCY_KINDS:
+        summary.update(latency[kind].summary_ms(kind))
+    return summary
+
+STEP_LATENCY_LOG_HEADER = list(step_latency_summary_ms(new_step_latency()).keys())
+
+class StageScope():
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timer.add(self.name, time.perf_counter() - self.start)
+
+NULL_STAGE_SCOPE = contextlib.nullcontext()
+
+class StageTimer():
+    # Cumulative wall time and call counts per named stage over one run.
+    # Scopes are reused per name, so a stage must not be entered again while it is already open.
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.seconds = {}
+        self.calls = {}
+        self.scopes = {}
+
+    def stage(self, name):
+        if not self.enabled:
+            return NULL_STAGE_SCOPE
+        try:
+            return self.scopes[name]
+        except KeyError:
+            scope = StageScope(self, name)
+            self.scopes[name] = scope
+            return scope
+
+    def add(self, name, seconds):
+        self.seconds[name] = self.seconds.get(name, 0.) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def count(self, name):
+        # For paths we only want to count, e.g. how many steps took the menu fast path
+        self.tally(name, 1)
+
+    def tally(self, name, n):
+        # Counts n events at once, with no time attached
+        if self.enabled:
+            self.seconds[name] = self.seconds.get(name, 0.)
+            self.calls[name] = self.calls.get(name, 0) + n
+
+    def to_dict(self):
+        return {name: {'seconds': self.seconds[name], 'calls': self.calls[name]} for name in self.seconds.keys()}
+
+class VersionedMemo():
+    # Values derived from some object's state, valid until that object's version number moves on.
+    # Hits and misses are counted per name so profiling can tell whether a memo earns its keep.
+    def __init__(self):
+        self.version = None
+        self.values = {}
+        self.hits = {}
+        self.misses = {}
+
+    def get(self, version, name, compute):
+        if version != self.version:
+            self.version = version
+            self.values.clear()
+        try:
+            value = self.values[name]
+        except KeyError:
+            self.misses[name] = self.misses.get(name, 0) + 1
+            value = compute()
+            self.values[name] = value
+            return value
+        self.hits[name] = self.hits.get(name, 0) + 1
+        return value
+
+    def to_dict(self):
+        return {name: {'hits': self.hits.get(name, 0), 'misses': self.misses[name]} for name in self.misses.keys()}
+
+def timed_stage(name):
+    # For code with no handle on the run state, e.g. Neighborhood and ThreatMap
+    if ARS.rs is None:
+        return NULL_STAGE_SCOPE
+    return ARS.rs.stage_timer.stage(name)
@@ -0,0 +1,42 @@
+import timeit
+
+import numpy as np
+import scipy.signal
+
+import agents.representation.morphology as morphology
+
+# Compares agents.representation.morphology against the scipy.signal.convolve2d floods it replaced
+# Run from the repository root: python -m utility.bench_morphology
+
+def convolve_dilate(mask):
+    return scipy.signal.convolve2d(mask, np.ones((3,3)), mode='same') >= 1
+
+def convolve_flood_fill(mask, within):
+    while True:
+        new_mask = convolve_dilate(mask) & within
+        if (new_mask == mask).all():
+            return mask
+        mask = new_mask
+
+def convolve_neighbor_counts(mask):
+    return scipy.signal.convolve2d(mask, np.ones((3,3)), mode='same')
+
+rng = np.random.default_rng(0)
+mask = rng.random((21, 79)) < 0.05
+masks = rng.random((8, 21, 79)) < 0.01
+room_floor = np.full((21, 79), False)
+room_floor[3:15, 10:60] = True
+seed = np.full((21, 79), False)
+seed[9, 35] = True
+
+cases = [
+    ('dilate', lambda: convolve_dilate(mask), lambda: morphology.dilate(mask)),
+    ('dilate 8 stacked', lambda: [convolve_dilate(m) for m in masks], lambda: morphology.dilate(masks)),
+    ('flood_fill room', lambda: convolve_flood_fill(seed, room_floor), lambda: morphology.flood_fill(seed, room_floor)),
+    ('neighbor_counts', lambda: convolve_neighbor_counts(mask), lambda: morphology.neighbor_counts(mask)),
+]
+
+for name, old, new in cases:
+    old_seconds = min(timeit.repeat(old, number=200, repeat=5)) / 200
+    new_seconds = min(timeit.repeat(new, number=200, repeat=5)) / 200
+    print(f"{name:<20} convolve2d {old_seconds * 1e6:8.1f}us  morphology {new_seconds * 1e6:8.1f}us  {old_seconds / new_seconds:5.1f}x")